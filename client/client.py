@@ -2,8 +2,8 @@ import socket
 import threading
 import select
 import queue
-
-BUFFER = 1024
+import codes
+from localring import connectLocal
 
 class Client(threading.Thread):
     
@@ -20,6 +20,8 @@ class Client(threading.Thread):
         self.clientSocket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sendQueue = sendQueue
         self.recvQueue = recvQueue
+        self.reader = codes.FrameReader()  # Reusable receive buffer
+        self.pending = b""  # Bytes of a partially received frame
     
     def connect(self) -> bool:
         # Ensure socket times out during lengthy connects
@@ -36,20 +38,41 @@ class Client(threading.Thread):
         self.start()
         return True
     
+    # Attach over shared memory to a server on this host instead of TCP
+    def connectLocal(self, path) -> bool:
+        try:
+            session = connectLocal(path)
+        except OSError as err:
+            return False
+
+        self.clientSocket.close()
+        self.clientSocket = session
+
+        # Start thread that runs client
+        self.start()
+        return True
+
     def disconnect(self):
         self.closing.set()
 
     # Returns false if the server closed the connection
     def read(self) -> bool:
         
-        # Read message from socket
-        message = self.clientSocket.recv(BUFFER)
+        # Read frames from socket, one read can hold several frames, or part of one
+        try:
+            received = self.reader.read(self.clientSocket, self.pending)
+        # Woken up with nothing to read
+        except BlockingIOError:
+            return True
 
         # Closed connections send empty messages
-        if not message:
+        if received is None:
             return False
         
-        self.recvQueue.put(message)
+        # Frames are views into the reader's buffer, the interface thread needs copies
+        frames, self.pending = received
+        for frame in frames:
+            self.recvQueue.put(bytes(frame))
         return True
 
     def write(self):
@@ -1,8 +1,10 @@
 import socket
 import threading
+import codes
 from client import Client
 from interface import Interface
 import queue
+import argparse
 
 
 HOST = "127.0.0.1"  # The server's hostname or IP address
@@ -12,13 +14,32 @@ PORT = 65432  # The port used by the server
 recvQueue = queue.Queue()
 sendQueue = queue.Queue()
 
+parser = argparse.ArgumentParser(description="DreyChat client")
+parser.add_argument("--live-view", action="store_true", help="keep a live copy of user and channel lists instead of asking the server each time")
+parser.add_argument("--local-path", default=None, help="attach over shared memory to a server on this host")
+args = parser.parse_args()
+
 client = Client(HOST, PORT, sendQueue, recvQueue)
 
-if client.connect() == False:
+connected = client.connect() if args.local_path is None else client.connectLocal(args.local_path)
+if connected == False:
     print('Failed to connect to server.')
 else:
     interface = Interface(sendQueue, recvQueue)
 
+    # Compact frames if the server supports them, v1 otherwise
+    try:
+        interface.negotiate(codes.PROTOCOL_V2)
+    except queue.Empty:
+        pass
+
+    # Every user and channel change is pushed to subscribers, so only on request
+    if args.live_view:
+        try:
+            interface.subscribe(True)
+        except queue.Empty:
+            pass
+
     while client.is_alive():
         print("[0] Quit")
         interface.displayMenu()
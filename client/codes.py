@@ -17,45 +17,194 @@ LIST_CHANNELS = 11  # Type
 LIST_MY_CHANNELS = 12   # Type 
 LIST_CHANNEL_USERS = 13  # Type
 LIST_USERS = 14  # Type 
+HELLO = 15  # Type length string
+ID_MAP = 16  # Type Count (length string length string length string)*
+INBOX_IDS = 17  # Type length string length string length string
+HEARTBEAT = 18  # Type
+
+# Server to server link frames
+PEER_HELLO = 19  # Type length string length string
+PEER_USER = 20  # Type length string length string length string
+PEER_CHANNEL = 21  # Type length string length string
+PEER_INBOX = 22  # Type length string length string length string length string
+PEER_FRAMES = (PEER_HELLO, PEER_USER, PEER_CHANNEL, PEER_INBOX)
+
+SEARCH = 23  # Type length string (length string)*
+BROWSE_CHANNELS = 24  # Type length string
+SUBSCRIBE = 25  # Type length string
+DELTA = 26  # Type Count (length string length string length string)*
 
 MAX_MESSAGE_SIZE = 1024
 
-def extractInt(request: bytes)-> Tuple[int, bytes]:
-        intSize = struct.calcsize("!I")
-        (num,), remainingBytes = struct.unpack("!I", request[:intSize]), request[intSize:]
-        return num, remainingBytes
-
-def extractString(request: bytes)-> Tuple[str, bytes]:
-        intSize = struct.calcsize("!I")
-        (length,), remainingBytes = struct.unpack("!I", request[:intSize]), request[intSize:]
-        (string,), remainingBytes = struct.unpack(f"!{length}s", remainingBytes[:length]), remainingBytes[length:]
-        return string.decode('utf-8'), remainingBytes
-
-def unpack(request: bytes)-> List:
-        # Extract header code
-        code, remainingBytes = extractInt(request)
-        # Extract field count
-        count, remainingBytes = extractInt(remainingBytes)
+# Fields each code accepts in a request, (fewest, most), None for no limit
+FIELD_COUNTS: Dict[int, Tuple[int, Optional[int]]] = {
+    SET_NAME: (1, 1),
+    MESSAGE_USER: (2, 2),
+    MESSAGE_MY_CHANNELS: (1, 1),
+    MESSAGE_CHANNELS: (2, None),
+    JOIN_CHANNELS: (1, None),
+    LEAVE_CHANNELS: (1, None),
+    CREATE_CHANNEL: (1, 1),
+    DELETE_CHANNEL: (1, 1),
+    LIST_CHANNELS: (0, 0),
+    LIST_MY_CHANNELS: (0, 0),
+    LIST_CHANNEL_USERS: (1, 1),
+    LIST_USERS: (0, 0),
+    HELLO: (1, 1),
+    HEARTBEAT: (0, 0),
+    PEER_HELLO: (2, 2),
+    PEER_USER: (3, 3),
+    PEER_CHANNEL: (2, 2),
+    PEER_INBOX: (4, 4),
+    SEARCH: (1, None),
+    BROWSE_CHANNELS: (1, 1),
+    SUBSCRIBE: (1, 1),
+}
+
+# Protocol versions, negotiated with HELLO
+PROTOCOL_V1 = 1
+PROTOCOL_V2 = 2
+
+# ID_MAP entry kinds
+CHANNEL_ID = "c"
+USER_ID = "u"
+
+# PEER_USER and PEER_CHANNEL operations
+PEER_ADD = "+"
+PEER_REMOVE = "-"
+PEER_DELETE = "x"
+
+# SUBSCRIBE arguments
+SUBSCRIBE_ON = "1"
+SUBSCRIBE_OFF = "0"
+
+# DELTA entry operations, each entry is (op, name, name), unused names are empty
+DELTA_RESET = "*"  # Start of a snapshot, drop the cached view
+DELTA_SNAPSHOT_END = "."  # Snapshot complete, the view can answer queries
+DELTA_USER_ADD = "u+"  # user
+DELTA_USER_REMOVE = "u-"  # user
+DELTA_USER_RENAME = "u~"  # old name, new name
+DELTA_CHANNEL_ADD = "c+"  # channel
+DELTA_CHANNEL_REMOVE = "c-"  # channel, its members go with it
+DELTA_MEMBER_ADD = "m+"  # channel, user
+DELTA_MEMBER_REMOVE = "m-"  # channel, user
+
+# Interned IDs are sent as "#<number>", which can never be a valid name
+ID_PREFIX = "#"
+
+HEADER = struct.Struct("!II")  # Code, field count
+LENGTH = struct.Struct("!I")  # Field length
+
+# Works on bytes, bytearray or memoryview, fields are decoded in place instead of sliced off
+def unpack(request)-> List:
+        # Extract header code and field count
+        code, count = HEADER.unpack_from(request)
+        offset = HEADER.size
+        view = memoryview(request)
 
         unpackedList: List = [code]
 
         for _ in range(count):
-            string, remainingBytes = extractString(remainingBytes)
-            unpackedList.append(string)
+            (length,) = LENGTH.unpack_from(request, offset)
+            offset += LENGTH.size
+            unpackedList.append(str(view[offset:offset + length], 'utf-8'))
+            offset += length
 
         return unpackedList
 
 def pack(tokens: List)-> bytes:
         # Add code and header count
-        message = struct.pack('!II', tokens[0], len(tokens) - 1)
+        parts: List[bytes] = [HEADER.pack(tokens[0], len(tokens) - 1)]
 
-        # Add fields
+        # Add fields, joined once so long frames aren't copied for every field
         for i in range(1, len(tokens)):
             encodedString = tokens[i].encode('utf-8')
-            message += struct.pack(f'!I{len(encodedString)}s', len(encodedString), encodedString)
+            parts.append(LENGTH.pack(len(encodedString)))
+            parts.append(encodedString)
+
+        return b"".join(parts)
 
-        return message
 
+# Size of the frame at start, 0 if it hasn't fully arrived by end
+def frameLength(buffer, start: int = 0, end: Optional[int] = None) -> int:
+        if end is None:
+            end = len(buffer)
+        if end - start < HEADER.size:
+            return 0
+
+        # Skip header, then each length prefixed field
+        _, count = HEADER.unpack_from(buffer, start)
+        position = start + HEADER.size
+        for _ in range(count):
+            if end < position + LENGTH.size:
+                return 0
+            (length,) = LENGTH.unpack_from(buffer, position)
+            position += LENGTH.size + length
+
+        if end < position:
+            return 0
+        return position - start
+
+# Split a stream into whole frames and the incomplete remainder
+def splitFrames(buffer: bytes) -> Tuple[List[bytes], bytes]:
+        frames: List[bytes] = []
+        start = 0
+        while True:
+            length = frameLength(buffer, start)
+            if length == 0:
+                return frames, buffer[start:]
+            frames.append(buffer[start:start + length])
+            start += length
+
+RECV_SIZE = 1024  # Starting size of a receive buffer
+MAX_RECV_SIZE = 65536  # Buffers stop growing here, unless a partial frame needs more
+
+class FrameReader:
+    # Reads with recv_into into one reusable buffer, shared by every connection a thread reads.
+    # Frames come out as memoryviews into the buffer and are only valid until the next read,
+    # copy any that must outlive it. Connections keep just the bytes of a partial frame.
+    def __init__(self) -> None:
+        self._buffer: bytearray = bytearray(RECV_SIZE)
+        self._view: memoryview = memoryview(self._buffer)
+
+    # Views handed out earlier keep the old buffer alive
+    def _resize(self, size: int) -> None:
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+
+    # Returns whole frames and the new partial frame, None if the connection closed
+    def read(self, connection, pending: bytes) -> Optional[Tuple[List[memoryview], bytes]]:
+        # Partial frame goes in front, with at least as much room again after it
+        if 2 * len(pending) > len(self._buffer):
+            self._resize(2 * len(pending))
+        view = self._view
+        view[:len(pending)] = pending
+
+        received = connection.recv_into(view[len(pending):])
+        if received == 0:
+            return None
+        end = len(pending) + received
+
+        frames: List[memoryview] = []
+        start = 0
+        while True:
+            length = frameLength(view, start, end)
+            if length == 0:
+                break
+            frames.append(view[start:start + length])
+            start += length
+
+        # A read that filled the buffer means more is waiting, grow for heavy senders
+        if end == len(self._buffer) and len(self._buffer) < MAX_RECV_SIZE:
+            self._resize(2 * len(self._buffer))
+
+        return frames, bytes(view[start:end])
+
+def idRef(num: int) -> str:
+    return ID_PREFIX + str(num)
+
+def isIDRef(string: str) -> bool:
+    return string.startswith(ID_PREFIX)
 
 def isValidName(string: str) -> bool:
     if len(string) > 25:
@@ -64,6 +213,14 @@ def isValidName(string: str) -> bool:
     pattern = r'^[a-zA-Z0-9_.]+(?: [a-zA-Z0-9_.]+)*$'
     return re.match(pattern, string) is not None
 
+# Channel name prefix, or a glob with * and ?, empty browses the top level
+def isValidPattern(string: str) -> bool:
+    if len(string) > 25:
+        return False
+
+    pattern = r'^[a-zA-Z0-9_. *?]*$'
+    return re.match(pattern, string) is not None
+
 def getLabel(prompt: str) -> str:
         label: str = input(prompt)
         
@@ -80,5 +237,13 @@ def getLabels(prompt: str) -> str:
 
         return label
 
+# Known request code with a field count its handler can read
+def hasValidFields(tokens: List) -> bool:
+    if tokens[0] not in FIELD_COUNTS:
+        return False
+    fewest, most = FIELD_COUNTS[tokens[0]]
+    count = len(tokens) - 1
+    return fewest <= count and (most is None or count <= most)
+
 def isMessageValid(message: bytes) -> bool:
        return len(message) <= MAX_MESSAGE_SIZE
\ No newline at end of file
@@ -20,6 +20,22 @@ class Interface(threading.Thread):
         self.replyQueue: queue.Queue = queue.Queue(maxsize=1)
         self.inbox: queue.Queue = queue.Queue()
 
+        # Protocol v2 ID mappings pushed by the server
+        self.protocol: int = codes.PROTOCOL_V1
+        # ref -> name, name -> ref
+        self.channelNames: Dict[str, str] = {}
+        self.channelRefs: Dict[str, str] = {}
+        self.userNames: Dict[str, str] = {}
+        self.userRefs: Dict[str, str] = {}
+
+        # Cached view kept up to date by DELTA frames once subscribed, answers list queries.
+        # Dicts keep arrival order, like the server's lists.
+        self.subscribed: bool = False
+        self.viewReady: bool = False    # Set once the snapshot arrives
+        self.viewUsers: Dict[str, None] = {}
+        # Channel -> local member names, empty for channels with members on other servers only
+        self.viewChannels: Dict[str, Dict[str, None]] = {}
+
         self.start()
     
      # Run thread    
@@ -34,14 +50,117 @@ class Interface(threading.Thread):
                 tokens: List = codes.unpack(message)
                 if tokens[0] == codes.ERROR or tokens[0] == codes.SUCCESS:
                     self.replyQueue.put(tokens, block=True, timeout=None)
+                elif tokens[0] == codes.ID_MAP:
+                    self.updateMap(tokens[1:])
+                elif tokens[0] == codes.DELTA:
+                    self.updateView(tokens[1:])
+                elif tokens[0] == codes.INBOX_IDS:
+                    self.inbox.put(self.expandInbox(tokens), block=True, timeout=None)
+                # Server checking that we're still alive
+                elif tokens[0] == codes.HEARTBEAT:
+                    self.sendQueue.put(codes.pack([codes.HEARTBEAT]))
                 else:
                     self.inbox.put(tokens, block=True, timeout=None)
 
     def stop(self):
         self._closing.set()
 
+    # Ask the server for a protocol version, stays on v1 if refused
+    def negotiate(self, version: int) -> bool:
+        request: bytes = codes.pack([codes.HELLO, str(version)])
+        self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
+
+        replyTokens = self.replyQueue.get(block=True, timeout=WAIT_INTERVAL)
+        if replyTokens[0] != codes.SUCCESS:
+            return False
+        self.protocol = version
+        return True
+
+    # Ask the server to push user and channel changes, list queries are then answered locally
+    def subscribe(self, on: bool) -> bool:
+        # The server only sends a snapshot when the subscription starts
+        if on == self.subscribed:
+            return True
+
+        # Cleared before asking, the snapshot can arrive ahead of the reply
+        self.viewReady = False
+        request: bytes = codes.pack([codes.SUBSCRIBE, codes.SUBSCRIBE_ON if on else codes.SUBSCRIBE_OFF])
+        self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
+
+        replyTokens = self.replyQueue.get(block=True, timeout=WAIT_INTERVAL)
+        if replyTokens[0] != codes.SUCCESS:
+            return False
+        self.subscribed = on
+        return True
+
+    # Apply (op, name, name) triples
+    def updateView(self, fields: List[str]):
+        for i in range(0, len(fields) - 2, 3):
+            op, first, second = fields[i:i + 3]
+
+            match op:
+                # Snapshots span several frames, lists are only answered locally once all have arrived
+                case codes.DELTA_RESET:
+                    self.viewUsers = {}
+                    self.viewChannels = {}
+                    self.viewReady = False
+                case codes.DELTA_SNAPSHOT_END:
+                    self.viewReady = True
+                case codes.DELTA_USER_ADD:
+                    self.viewUsers[first] = None
+                case codes.DELTA_USER_REMOVE:
+                    self.viewUsers.pop(first, None)
+                case codes.DELTA_USER_RENAME:
+                    self.viewUsers.pop(first, None)
+                    self.viewUsers[second] = None
+                    # Keep the member's place in each channel
+                    for channelName, members in list(self.viewChannels.items()):
+                        if first in members:
+                            self.viewChannels[channelName] = {(second if name == first else name): None for name in members}
+                case codes.DELTA_CHANNEL_ADD:
+                    self.viewChannels.setdefault(first, {})
+                case codes.DELTA_CHANNEL_REMOVE:
+                    self.viewChannels.pop(first, None)
+                case codes.DELTA_MEMBER_ADD:
+                    self.viewChannels.setdefault(first, {})[second] = None
+                case codes.DELTA_MEMBER_REMOVE:
+                    self.viewChannels.get(first, {}).pop(second, None)
+
+    # Apply (kind, ref, name) triples, an empty name drops the ref
+    def updateMap(self, fields: List[str]):
+        for i in range(0, len(fields) - 2, 3):
+            kind, ref, name = fields[i:i + 3]
+            names, refs = (self.channelNames, self.channelRefs) if kind == codes.CHANNEL_ID else (self.userNames, self.userRefs)
+
+            oldName = names.pop(ref, None)
+            if oldName is not None and refs.get(oldName) == ref:
+                del refs[oldName]
+            if name != "":
+                names[ref] = name
+                refs[name] = ref
+
+    # Turn an ID based inbox frame back into a readable one
+    def expandInbox(self, tokens: List) -> List:
+        channelRef, senderRef, text = tokens[1:4]
+        senderName = self.userNames.get(senderRef, senderRef)
+        if channelRef == "":
+            return [codes.INBOX, senderName + ": " + text + "\n"]
+        channelName = self.channelNames.get(channelRef, channelRef)
+        return [codes.INBOX, channelName + "|" + senderName + ": " + text + "\n"]
+
+    # Refer to known channels and users by ID once on v2
+    def channelField(self, channelName: str) -> str:
+        if self.protocol == codes.PROTOCOL_V2:
+            return self.channelRefs.get(channelName, channelName)
+        return channelName
+
+    def userField(self, name: str) -> str:
+        if self.protocol == codes.PROTOCOL_V2:
+            return self.userRefs.get(name, name)
+        return name
+
     def displayMenu(self):
-        print("[1] Message\n[2] Join/Leave Channels\n[3] Create/Delete Channel\n[4] List Channels\n[5] List My Channels\n[6] List Channel Users\n[7] List Users\n[8] Set Name\n[9] Empty Inbox")
+        print("[1] Message\n[2] Join/Leave Channels\n[3] Create/Delete Channel\n[4] List Channels\n[5] List My Channels\n[6] List Channel Users\n[7] List Users\n[8] Set Name\n[9] Empty Inbox\n[10] Search Messages\n[11] Browse Channels")
             
     def choose(self, choice: int):
         print("")
@@ -130,6 +249,12 @@ class Interface(threading.Thread):
             # Empty inbox
             case '9':
                 self.emptyInbox()
+            # Search messages
+            case '10':
+                self.search()
+            # Browse channels
+            case '11':
+                self.browseChannels()
             case _:
                 print("Invalid Choice\n")
     
@@ -138,10 +263,20 @@ class Interface(threading.Thread):
         assert replyTokens[0] == codes.ERROR or replyTokens[0] == codes.SUCCESS
         print("\nDreychat:\n" + replyTokens[1])
 
+    # Answer from the cached view, worded like the server's reply
+    def printView(self, names: List[str], emptyReply: str):
+        reply: str = ""
+        for count, name in enumerate(names):
+            reply = reply + str(count + 1) + ". " + name + "\n"
+        print("\nDreychat:\n" + (reply if reply != "" else emptyReply))
+
+    def useView(self) -> bool:
+        return self.subscribed and self.viewReady
+
     def messageUser(self):
         name: str = codes.getLabel("Username: ") 
         message: str = input("Message: ")  
-        request: bytes = codes.pack([codes.MESSAGE_USER, name, message])
+        request: bytes = codes.pack([codes.MESSAGE_USER, self.userField(name), message])
         if not codes.isMessageValid(request):
             print("Unable to send request, too long.\n")
             return
@@ -165,7 +300,7 @@ class Interface(threading.Thread):
             channel: str = codes.getLabels("Channel name:")
             if channel == "":
                 break
-            reqTokens.append(channel)
+            reqTokens.append(self.channelField(channel))
 
         if len(reqTokens) == 1:
             return
@@ -185,7 +320,7 @@ class Interface(threading.Thread):
             channel: str = codes.getLabels("Channel name:")
             if channel == "":
                 break
-            reqTokens.append(channel)
+            reqTokens.append(self.channelField(channel))
 
         if len(reqTokens) == 1:
             return
@@ -201,7 +336,7 @@ class Interface(threading.Thread):
             channel: str = codes.getLabels("Channel name:")
             if channel == "":
                 break
-            reqTokens.append(channel)
+            reqTokens.append(self.channelField(channel))
 
         if len(reqTokens) == 1:
             return
@@ -220,12 +355,16 @@ class Interface(threading.Thread):
 
     def deleteChannel(self):
         channelName: str = codes.getLabel("Channel Name: ")   
-        request: bytes = codes.pack([codes.DELETE_CHANNEL, channelName])
+        request: bytes = codes.pack([codes.DELETE_CHANNEL, self.channelField(channelName)])
         self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
 
         self.getReply()
         
     def listChannels(self):
+        if self.useView():
+            self.printView(list(self.viewChannels), "No channels exist.\n")
+            return
+
         request: bytes = codes.pack([codes.LIST_CHANNELS])
         self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
 
@@ -239,17 +378,53 @@ class Interface(threading.Thread):
 
     def listChannelUsers(self):
         channelName: str = codes.getLabel("Channel Name: ") 
-        request: bytes = codes.pack([codes.LIST_CHANNEL_USERS, channelName])
+        if self.useView():
+            # Channels with no members on our server can't be listed
+            self.printView(list(self.viewChannels.get(channelName, ())), channelName + " does not exist.\n")
+            return
+
+        request: bytes = codes.pack([codes.LIST_CHANNEL_USERS, self.channelField(channelName)])
         self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
 
         self.getReply()
 
     def listUsers(self):
+        if self.useView():
+            self.printView(list(self.viewUsers), "")
+            return
+
         request: bytes = codes.pack([codes.LIST_USERS])
         self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
 
         self.getReply()
 
+    # Channels left out search every channel the user is in
+    def search(self):
+        reqTokens: List = [codes.SEARCH, input("Search for: ")]
+        while True:
+            channel: str = codes.getLabels("Channel name:")
+            if channel == "":
+                break
+            reqTokens.append(self.channelField(channel))
+
+        request: bytes = codes.pack(reqTokens)
+        if not codes.isMessageValid(request):
+            print("Unable to send request, too long.\n")
+            return
+        self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
+
+        self.getReply()
+
+    def browseChannels(self):
+        query: str = input("Channel prefix or pattern (* and ?): ")
+        while not codes.isValidPattern(query):
+            query = input("Try again, Channel prefix or pattern (* and ?): ")
+
+        request: bytes = codes.pack([codes.BROWSE_CHANNELS, query])
+        self.sendQueue.put(request, block=True, timeout=WAIT_INTERVAL)
+
+        self.getReply()
+
     def setName(self):
         newName: str = codes.getLabel("New Name: ") 
         request: bytes = codes.pack([codes.SET_NAME, newName])
@@ -0,0 +1,229 @@
+import os
+import mmap
+import socket
+import struct
+from typing import List, Tuple
+
+# Local transport for clients on the same host as the server.
+# Frames go through two single producer, single consumer rings in a shared
+# memfd mapping, eventfds wake the other side. The handshake over a unix
+# socket only passes the descriptors, then the socket is closed.
+
+RING_SIZE = 1 << 20  # Bytes of frame data per direction
+HEADER = struct.Struct("=QQI")  # Bytes written, bytes read, producer closed
+HEADER_SIZE = 64  # Header padded to a cache line
+LENGTH = struct.Struct("=I")
+MAPPING_SIZE = 2 * (HEADER_SIZE + RING_SIZE)
+
+# Ring indexes within the mapping
+TO_SERVER = 0
+TO_CLIENT = 1
+
+class Ring:
+    # Counters only grow, used space is written - read.
+    # Relies on stores to the mapping staying in order (x86).
+    def __init__(self, buffer: mmap.mmap, index: int) -> None:
+        self._buffer: mmap.mmap = buffer
+        self._header: int = index * (HEADER_SIZE + RING_SIZE)
+        self._data: int = self._header + HEADER_SIZE
+        self._partial: int = 0    # Consumer side, bytes of the front frame already read by readInto
+
+    def _counters(self) -> Tuple[int, int, int]:
+        return HEADER.unpack_from(self._buffer, self._header)
+
+    def _copyIn(self, position: int, data: bytes) -> None:
+        start = position % RING_SIZE
+        first = min(len(data), RING_SIZE - start)
+        self._buffer[self._data + start:self._data + start + first] = data[:first]
+        # Wrap around to the front
+        if first < len(data):
+            self._buffer[self._data:self._data + len(data) - first] = data[first:]
+
+    def _copyOut(self, position: int, length: int) -> bytes:
+        start = position % RING_SIZE
+        first = min(length, RING_SIZE - start)
+        data = self._buffer[self._data + start:self._data + start + first]
+        # Wrap around to the front
+        if first < length:
+            data += self._buffer[self._data:self._data + length - first]
+        return data
+
+    # Copy straight into view, no intermediate bytes
+    def _copyOutInto(self, position: int, view: memoryview) -> None:
+        start = position % RING_SIZE
+        first = min(len(view), RING_SIZE - start)
+        with memoryview(self._buffer) as mapping:
+            view[:first] = mapping[self._data + start:self._data + start + first]
+            # Wrap around to the front
+            if first < len(view):
+                view[first:] = mapping[self._data:self._data + len(view) - first]
+
+    # Producer side, returns false if the frame doesn't fit
+    def push(self, frame: bytes) -> bool:
+        written, read, closed = self._counters()
+        if RING_SIZE - (written - read) < LENGTH.size + len(frame):
+            return False
+
+        self._copyIn(written, LENGTH.pack(len(frame)))
+        self._copyIn(written + LENGTH.size, frame)
+        # Publish only once the frame is in place
+        struct.pack_into("=Q", self._buffer, self._header, written + LENGTH.size + len(frame))
+        return True
+
+    # Consumer side, fills view with as much of the frame stream as fits, like recv_into.
+    # A frame too big for the space left is read over several calls.
+    def readInto(self, view: memoryview) -> int:
+        copied = 0
+        while copied < len(view):
+            written, read, _ = self._counters()
+            if written == read:
+                break
+
+            (length,) = LENGTH.unpack(self._copyOut(read, LENGTH.size))
+            size = min(length - self._partial, len(view) - copied)
+            self._copyOutInto(read + LENGTH.size + self._partial, view[copied:copied + size])
+            copied += size
+            self._partial += size
+
+            # Release the frame only once all of it has been read
+            if self._partial == length:
+                self._partial = 0
+                struct.pack_into("=Q", self._buffer, self._header + 8, read + LENGTH.size + length)
+
+        return copied
+
+    def empty(self) -> bool:
+        written, read, _ = self._counters()
+        return written == read
+
+    def closed(self) -> bool:
+        return self._counters()[2] != 0
+
+    def close(self) -> None:
+        struct.pack_into("=I", self._buffer, self._header + 16, 1)
+
+class LocalSession:
+    # Quacks like a non-blocking socket so select and Server treat it the same
+    def __init__(self, memfd: int, waitFd: int, signalFd: int, inbound: int) -> None:
+        self._mapping: mmap.mmap = mmap.mmap(memfd, MAPPING_SIZE)
+        os.close(memfd)
+
+        self._inbound: Ring = Ring(self._mapping, inbound)
+        self._outbound: Ring = Ring(self._mapping, 1 - inbound)
+        self._waitFd: int = waitFd    # Signalled when inbound has frames
+        self._signalFd: int = signalFd    # Signalled after pushing outbound
+        self._open: bool = True
+
+    def fileno(self) -> int:
+        return self._waitFd
+
+    def setblocking(self, flag: bool) -> None:
+        pass
+
+    # Fills buffer like socket.recv_into, 0 once the other side has closed and drained
+    def recv_into(self, buffer: memoryview) -> int:
+        # Clear the wakeup before looking, a racing push re-arms it
+        try:
+            os.eventfd_read(self._waitFd)
+        except BlockingIOError:
+            pass
+
+        received = self._inbound.readInto(buffer)
+        if received == 0:
+            if self._inbound.closed():
+                return 0
+            raise BlockingIOError("no frames ready")
+
+        # Stay readable while frames are left
+        if not self._inbound.empty():
+            os.eventfd_write(self._waitFd, 1)
+        return received
+
+    # A full ring means the reader stalled, like a full socket buffer
+    def sendall(self, data: bytes) -> None:
+        if not self._outbound.push(data):
+            raise BlockingIOError("ring full")
+        os.eventfd_write(self._signalFd, 1)
+
+    def send(self, data: bytes) -> int:
+        self.sendall(data)
+        return len(data)
+
+    def close(self) -> None:
+        if not self._open:
+            return
+        self._open = False
+
+        # Let the other side see the hang up
+        self._outbound.close()
+        os.eventfd_write(self._signalFd, 1)
+
+        os.close(self._waitFd)
+        os.close(self._signalFd)
+        self._mapping.close()
+
+class LocalListener:
+    # Hands out sessions to local clients that connect to a unix socket
+    def __init__(self, path: str, backlog: int) -> None:
+        # Replace a socket file left by a previous run
+        if os.path.exists(path):
+            os.unlink(path)
+
+        self._socket: socket.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.setblocking(False)
+        self._socket.bind(path)
+        self._socket.listen(backlog)
+
+    def fileno(self) -> int:
+        return self._socket.fileno()
+
+    # Same shape as socket.accept so Server can drain both kinds of listener
+    def accept(self) -> Tuple[LocalSession, None]:
+        conn, _ = self._socket.accept()
+
+        # Close whatever was created if we run out of descriptors or the client goes away
+        descriptors: List[int] = []
+        try:
+            memfd = os.memfd_create("dreychat")
+            descriptors.append(memfd)
+            os.ftruncate(memfd, MAPPING_SIZE)
+            toServer = os.eventfd(0, os.EFD_NONBLOCK)
+            descriptors.append(toServer)
+            toClient = os.eventfd(0, os.EFD_NONBLOCK)
+            descriptors.append(toClient)
+
+            # Client keeps its own copies of the descriptors
+            conn.setblocking(True)
+            socket.send_fds(conn, [b"dreychat"], [memfd, toServer, toClient])
+            session = LocalSession(memfd, toServer, toClient, TO_SERVER)
+        except BaseException:
+            for descriptor in descriptors:
+                os.close(descriptor)
+            raise
+        finally:
+            conn.close()
+
+        return session, None
+
+    def close(self) -> None:
+        path = self._socket.getsockname()
+        self._socket.close()
+        os.unlink(path)
+
+# Client side of the handshake
+def connectLocal(path: str) -> LocalSession:
+    handshake = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        handshake.settimeout(5)
+        handshake.connect(path)
+        _, fds, _, _ = socket.recv_fds(handshake, 16, 3)
+    finally:
+        handshake.close()
+
+    if len(fds) != 3:
+        for descriptor in fds:
+            os.close(descriptor)
+        raise ConnectionError("bad local handshake")
+
+    memfd, toServer, toClient = fds
+    return LocalSession(memfd, toClient, toServer, TO_CLIENT)
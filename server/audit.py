@@ -0,0 +1,151 @@
+import os
+import re
+import json
+import time
+import threading
+import collections
+from typing import Dict, Any, List, Optional, Tuple, Deque
+
+# Audit trail of user and channel messages, written off the request path.
+# The interface appends records to a deque, which needs no lock, and a writer
+# thread drains it in batches into size rotated segment files, one JSON object
+# per line. The deque is bounded, when the writer falls behind records are
+# dropped and counted rather than making requests wait, and the gap is
+# written into the trail.
+
+BATCH_INTERVAL = 0.1  # Seconds between writer passes
+FSYNC_PERIOD = 1.0  # Seconds between fsyncs under the "interval" policy
+
+# fsync policies
+FSYNC_BATCH = "batch"  # After every batch, nothing written is lost on a crash
+FSYNC_INTERVAL = "interval"  # At most once per FSYNC_PERIOD
+FSYNC_NEVER = "never"  # Left to the OS
+FSYNC_POLICIES = (FSYNC_BATCH, FSYNC_INTERVAL, FSYNC_NEVER)
+
+# Record kinds
+USER_MESSAGE = "user"
+CHANNEL_MESSAGE = "channel"
+DROPPED = "dropped"
+
+SEGMENT_NAME = re.compile(r"^audit-(\d+)\.jsonl$")
+
+class AuditSink(threading.Thread):
+    def __init__(self, DIRECTORY: str, SEGMENT_SIZE: int, FSYNC: str, MAX_BACKLOG: int) -> None:
+        threading.Thread.__init__(self)
+
+        # Let main thread signal when to close the sink
+        self._closing: threading.Event = threading.Event()
+
+        self.directory: str = DIRECTORY
+        self.segmentSize: int = SEGMENT_SIZE    # Bytes written before rotating
+        self.fsync: str = FSYNC
+        self.maxBacklog: int = MAX_BACKLOG
+
+        # (time, kind, sender, target, text), appended by the interface, popped by the writer
+        self._records: Deque[Tuple[float, str, str, str, str]] = collections.deque()
+
+        # Metrics, only read by other threads
+        self.written: int = 0
+        self.dropped: int = 0
+        self._droppedLogged: int = 0
+
+        # Continue numbering after segments left by earlier runs
+        os.makedirs(self.directory, exist_ok=True)
+        numbers = [int(match.group(1)) for match in map(SEGMENT_NAME.match, os.listdir(self.directory)) if match]
+        self._segmentNumber: int = max(numbers, default=0)
+        self._file = None
+        self._size: int = 0
+        self._lastSync: float = time.monotonic()
+        self._unsynced: bool = False
+
+        self.start()
+
+    def stop(self) -> None:
+        self._closing.set()
+
+    # Called from the interface thread, never blocks
+    def record(self, kind: str, sender: str, target: str, text: str) -> None:
+        if len(self._records) >= self.maxBacklog:
+            self.dropped += 1
+            return
+        self._records.append((time.time(), kind, sender, target, text))
+
+    # Records waiting for the writer, and how long the oldest has waited
+    def stats(self) -> Dict[str, float]:
+        # The writer can pop the last record between a check and the index
+        try:
+            oldest = self._records[0][0]
+        except IndexError:
+            oldest = None
+        return {
+            "written": self.written,
+            "backlog": len(self._records),
+            "lag_seconds": time.time() - oldest if oldest is not None else 0.0,
+            "dropped": self.dropped,
+        }
+
+    def _rotate(self) -> None:
+        if self._file is not None:
+            self._sync(force=True)
+            self._file.close()
+
+        self._segmentNumber += 1
+        path = os.path.join(self.directory, "audit-" + str(self._segmentNumber).zfill(6) + ".jsonl")
+        self._file = open(path, "ab")
+        self._size = 0
+
+    def _sync(self, force: bool = False) -> None:
+        if self.fsync == FSYNC_NEVER:
+            self._file.flush()
+            return
+
+        now = time.monotonic()
+        if force or self.fsync == FSYNC_BATCH or now - self._lastSync >= FSYNC_PERIOD:
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._lastSync = now
+            self._unsynced = False
+        else:
+            self._unsynced = True
+
+    # Write everything queued so far as one batch
+    def _writeBatch(self) -> None:
+        lines: List[bytes] = []
+
+        # Mark gaps in the trail
+        dropped = self.dropped
+        if dropped != self._droppedLogged:
+            lines.append(json.dumps({"time": time.time(), "kind": DROPPED, "count": dropped - self._droppedLogged}).encode("utf-8") + b"\n")
+            self._droppedLogged = dropped
+
+        # Only take what's there now, records appended meanwhile wait for the next pass
+        count = len(self._records)
+        for _ in range(count):
+            timestamp, kind, sender, target, text = self._records.popleft()
+            lines.append(json.dumps({"time": timestamp, "kind": kind, "from": sender, "to": target, "text": text}).encode("utf-8") + b"\n")
+
+        # A quiet writer still syncs the tail of the last batch in time
+        if not lines:
+            if self._unsynced:
+                self._sync()
+            return
+
+        for line in lines:
+            if self._file is None or self._size >= self.segmentSize:
+                self._rotate()
+            self._file.write(line)
+            self._size += len(line)
+
+        self._sync()
+        self.written += count
+
+    # Run thread
+    def run(self) -> None:
+        while not self._closing.wait(BATCH_INTERVAL):
+            self._writeBatch()
+
+        # Flush what's left
+        self._writeBatch()
+        if self._file is not None:
+            self._sync(force=True)
+            self._file.close()
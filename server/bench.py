@@ -0,0 +1,194 @@
+import queue
+import random
+import time
+import json
+import argparse
+import tracemalloc
+import codes
+from interface import Interface
+from session import Session
+from audit import AuditSink
+from typing import Dict, Any, List, Optional, Tuple, Callable
+
+# Drives Interface.processRequest directly with generated frames, no sockets.
+# Each op runs as a timed batch, then again under tracemalloc for memory.
+
+class Workload:
+    def __init__(self, users: int, channels: int, members: int, seed: int, audit: Optional[AuditSink]) -> None:
+        self.random = random.Random(seed)
+
+        self.recvQueue: queue.Queue = queue.Queue()
+        self.newQueue: queue.Queue = queue.Queue()
+        self.removeQueue: queue.Queue = queue.Queue()
+
+        # Requests are fed by hand, so stop the thread straight away
+        self.interface = Interface(self.recvQueue, self.newQueue, self.removeQueue,
+                                   float("inf"), float("inf"), 0.0, "bench", None, 20000, None, audit)
+        self.interface.stop()
+        self.interface.join()
+
+        self.sessions: List[Session] = [self.connect() for _ in range(users)]
+        self.channelNames: List[str] = ["channel" + str(i) for i in range(channels)]
+
+        # Each channel gets a creator plus random members
+        for channelName in self.channelNames:
+            creator, *joiners = self.random.sample(self.sessions, min(members, users))
+            self.request(creator, [codes.CREATE_CHANNEL, channelName])
+            for member in joiners:
+                self.request(member, [codes.JOIN_CHANNELS, channelName])
+        self.drain()
+
+    # Sessions have no socket, the server side state is all in the session
+    def connect(self) -> Session:
+        session = Session(None)
+        self.newQueue.put(session)
+        return session
+
+    def disconnect(self, session: Session) -> None:
+        session.open = False
+        self.removeQueue.put(session)
+
+    def request(self, sender: Session, tokens: List) -> None:
+        self.interface.processRequest(sender, codes.pack(tokens))
+
+        # Count the sliced deliveries a request queued as part of its cost
+        while self.interface.fanoutOrder:
+            self.interface.runFanouts()
+
+    # Throw away everything the ops queued for clients
+    def drain(self) -> None:
+        for session in self.sessions:
+            session.sendQueue.clear()
+
+    def someUser(self) -> Session:
+        return self.random.choice(self.sessions)
+
+    def someChannel(self) -> str:
+        return self.random.choice(self.channelNames)
+
+    # Ops, each issues one request
+
+    def messageChannels(self) -> None:
+        self.request(self.someUser(), [codes.MESSAGE_CHANNELS, self.someChannel(), "benchmark message"])
+
+    def messageMyChannels(self) -> None:
+        self.request(self.someUser(), [codes.MESSAGE_MY_CHANNELS, "benchmark message"])
+
+    def messageUser(self) -> None:
+        sender, recipient = self.random.sample(self.sessions, 2)
+        self.request(sender, [codes.MESSAGE_USER, recipient.name, "benchmark message"])
+
+    def joinLeave(self) -> None:
+        sender, channelName = self.someUser(), self.someChannel()
+        if channelName in sender.channels:
+            self.request(sender, [codes.LEAVE_CHANNELS, channelName])
+        # Leaving can empty and remove a channel, joining brings it back
+        elif channelName not in self.interface.channels:
+            self.request(sender, [codes.CREATE_CHANNEL, channelName])
+        else:
+            self.request(sender, [codes.JOIN_CHANNELS, channelName])
+
+    def listChannels(self) -> None:
+        self.request(self.someUser(), [codes.LIST_CHANNELS])
+
+    def listUsers(self) -> None:
+        self.request(self.someUser(), [codes.LIST_USERS])
+
+    def listChannelUsers(self) -> None:
+        self.request(self.someUser(), [codes.LIST_CHANNEL_USERS, self.someChannel()])
+
+    def browseChannels(self) -> None:
+        self.request(self.someUser(), [codes.BROWSE_CHANNELS, self.random.choice(["", "channel", "channel1", "channel1*", "*9"])])
+
+    def search(self) -> None:
+        self.request(self.someUser(), [codes.SEARCH, self.random.choice(["benchmark", "message", "benchmark message", "missing"])])
+
+    # Disconnect a user and connect a replacement, the next request pays for clean
+    def churn(self) -> None:
+        leaving = self.random.randrange(len(self.sessions))
+        self.disconnect(self.sessions[leaving])
+        self.sessions[leaving] = self.connect()
+        self.request(self.someUser(), [codes.LIST_MY_CHANNELS])
+
+# Memory held per connected user that never sends anything, socket excluded
+def idleConnectionBytes(workload: Workload, connections: int) -> float:
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    idle = [workload.connect() for _ in range(connections)]
+    # Any request registers them
+    workload.request(workload.someUser(), [codes.LIST_MY_CHANNELS])
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    for session in idle:
+        workload.disconnect(session)
+    workload.request(workload.someUser(), [codes.LIST_MY_CHANNELS])
+    workload.drain()
+    return (after - before) / connections
+
+def measure(workload: Workload, op: Callable[[], None], iterations: int) -> Dict[str, float]:
+    # Timed batch
+    start = time.perf_counter()
+    for _ in range(iterations):
+        op()
+    elapsed = time.perf_counter() - start
+    workload.drain()
+
+    # Same batch again under tracemalloc, it slows things down too much to time
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    for _ in range(iterations):
+        op()
+    after, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    workload.drain()
+
+    return {
+        "ops_per_sec": iterations / elapsed,
+        "usec_per_op": elapsed / iterations * 1e6,
+        "retained_bytes_per_op": (after - before) / iterations,
+        "peak_kib": (peak - before) / 1024,
+    }
+
+parser = argparse.ArgumentParser(description="Benchmark Interface.processRequest without sockets")
+parser.add_argument("--users", type=int, default=1000)
+parser.add_argument("--channels", type=int, default=100)
+parser.add_argument("--members", type=int, default=50, help="members per channel")
+parser.add_argument("--iterations", type=int, default=1000, help="requests per op")
+parser.add_argument("--idle", type=int, default=10000, help="idle connections for the memory per connection measurement")
+parser.add_argument("--seed", type=int, default=0)
+parser.add_argument("--audit-path", default=None, metavar="DIR", help="audit messages to DIR, to measure the cost on the request path")
+parser.add_argument("--json", action="store_true", help="print results as JSON, for CI")
+args = parser.parse_args()
+
+audit = AuditSink(args.audit_path, 64 * 1024 * 1024, "interval", 1000000) if args.audit_path is not None else None
+workload = Workload(args.users, args.channels, args.members, args.seed, audit)
+ops: Dict[str, Callable[[], None]] = {
+    "message_channels": workload.messageChannels,
+    "message_my_channels": workload.messageMyChannels,
+    "message_user": workload.messageUser,
+    "join_leave": workload.joinLeave,
+    "list_channels": workload.listChannels,
+    "list_users": workload.listUsers,
+    "list_channel_users": workload.listChannelUsers,
+    "browse_channels": workload.browseChannels,
+    "search": workload.search,
+    "churn": workload.churn,
+}
+
+results = {name: measure(workload, op, args.iterations) for name, op in ops.items()}
+idleBytes = idleConnectionBytes(workload, args.idle)
+
+if audit is not None:
+    audit.stop()
+    audit.join()
+
+if args.json:
+    print(json.dumps({"config": vars(args), "results": results, "idle_connection_bytes": idleBytes}, indent=2))
+else:
+    print(f"{args.users} users, {args.channels} channels, {args.members} members per channel, {args.iterations} requests per op\n")
+    print(f"{'op':<22}{'ops/s':>12}{'us/op':>10}{'retained B/op':>15}{'peak KiB':>10}")
+    for name, result in results.items():
+        print(f"{name:<22}{result['ops_per_sec']:>12.0f}{result['usec_per_op']:>10.1f}"
+              f"{result['retained_bytes_per_op']:>15.1f}{result['peak_kib']:>10.1f}")
+    print(f"\n{idleBytes:.0f} bytes per idle connection, over {args.idle} connections")
@@ -0,0 +1,53 @@
+import struct
+import time
+from typing import Dict, Any, List, Optional, Tuple, Iterator
+
+# Capture file: MAGIC, then one RECORD per event followed by the frame bytes
+MAGIC = b"DREYCAP1"
+RECORD = struct.Struct("!dBII")  # Seconds since capture start, event, connection number, frame length
+
+# Events
+OPEN = 0
+CLOSE = 1
+INBOUND = 2
+OUTBOUND = 3
+
+class Capture:
+    # Only used from the server thread, so no locking
+    def __init__(self, path: str) -> None:
+        self._file = open(path, "wb", buffering=1 << 16)
+        self._file.write(MAGIC)
+        self._start: float = time.monotonic()
+
+    def _record(self, event: int, number: int, frame: bytes) -> None:
+        self._file.write(RECORD.pack(time.monotonic() - self._start, event, number, len(frame)))
+        self._file.write(frame)
+
+    # Connections are numbered by session ID, which is never reused
+    def opened(self, sessionID: int) -> None:
+        self._record(OPEN, sessionID, b"")
+
+    def closed(self, sessionID: int) -> None:
+        self._record(CLOSE, sessionID, b"")
+
+    def inbound(self, sessionID: int, frame: bytes) -> None:
+        self._record(INBOUND, sessionID, frame)
+
+    def outbound(self, sessionID: int, frame: bytes) -> None:
+        self._record(OUTBOUND, sessionID, frame)
+
+    def close(self) -> None:
+        self._file.close()
+
+# Yields (time, event, connection number, frame)
+def readCapture(path: str) -> Iterator[Tuple[float, int, int, bytes]]:
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError(path + " is not a capture file")
+
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            timestamp, event, number, length = RECORD.unpack(header)
+            yield timestamp, event, number, file.read(length)
@@ -0,0 +1,75 @@
+import bisect
+import fnmatch
+from typing import Dict, Any, List, Optional, Tuple
+
+# Sorted index of channel names for BROWSE_CHANNELS.
+# Every prefix is a contiguous range of the list, so counting a subtree is two
+# bisects and browsing one level jumps over whole subtrees at a time.
+# Names are split into levels at ".", like "team.ops.alerts".
+
+SEPARATOR = "."
+WILDCARDS = "*?"
+
+# First string after every string that starts with prefix
+def _prefixEnd(prefix: str) -> str:
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+def isPattern(query: str) -> bool:
+    return any(char in query for char in WILDCARDS)
+
+class ChannelDirectory:
+    def __init__(self) -> None:
+        self.names: List[str] = []
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name: str) -> bool:
+        index = bisect.bisect_left(self.names, name)
+        return index < len(self.names) and self.names[index] == name
+
+    def add(self, name: str) -> None:
+        bisect.insort(self.names, name)
+
+    def remove(self, name: str) -> None:
+        del self.names[bisect.bisect_left(self.names, name)]
+
+    # Index range of the names starting with prefix
+    def _range(self, prefix: str) -> Tuple[int, int]:
+        if prefix == "":
+            return 0, len(self.names)
+        return bisect.bisect_left(self.names, prefix), bisect.bisect_left(self.names, _prefixEnd(prefix))
+
+    def count(self, prefix: str) -> int:
+        start, end = self._range(prefix)
+        return end - start
+
+    # Names one level below prefix, with the number of channels at or under each
+    def children(self, prefix: str, limit: int) -> List[Tuple[str, int]]:
+        groups: Dict[str, int] = {}
+        index, end = self._range(prefix)
+
+        while index < end and len(groups) <= limit:
+            name = self.names[index]
+            group = prefix + name[len(prefix):].split(SEPARATOR, 1)[0]
+
+            # Count the whole subtree under the group at once and skip past it
+            if name.startswith(group + SEPARATOR):
+                subtreeStart, subtreeEnd = self._range(group + SEPARATOR)
+                groups[group] = groups.get(group, 0) + subtreeEnd - subtreeStart
+                index = subtreeEnd
+            else:
+                groups[group] = groups.get(group, 0) + 1
+                index += 1
+
+        return list(groups.items())[:limit]
+
+    # Names matching a glob pattern, only the range of its literal prefix is scanned
+    def match(self, pattern: str, limit: int) -> Tuple[List[str], int]:
+        literal = pattern
+        for char in WILDCARDS:
+            literal = literal.split(char, 1)[0]
+
+        start, end = self._range(literal)
+        matches = [name for name in self.names[start:end] if fnmatch.fnmatchcase(name, pattern)]
+        return matches[:limit], len(matches)
@@ -1,33 +1,88 @@
+import hmac
 import queue
+import struct
 import threading
+import itertools
+import collections
 import codes
-from typing import Dict, Any, List, Optional, Tuple
+from ratelimit import TokenBucket
+from session import Session
+from searchindex import SearchIndex
+from audit import AuditSink, USER_MESSAGE, CHANNEL_MESSAGE
+from directory import ChannelDirectory, isPattern
+from typing import Dict, Any, List, Optional, Tuple, Set, Deque
 
 CHECK_THREAD_TIME = 3
+FANOUT_SLICE = 1000  # Most deliveries made before letting other requests run
+SEARCH_RESULTS = 20  # Most messages a SEARCH returns
+BROWSE_RESULTS = 50  # Most rows a BROWSE_CHANNELS returns
+SNAPSHOT_ENTRIES = 100  # Most entries per snapshot frame, keeps frames small for any reader
 
 class Interface(threading.Thread):
-    def __init__(self, recvQueue: queue.Queue, sendQueues: Dict[int, queue.Queue], sendQueuesLock: threading.Lock, removeQueue: queue.Queue):
+    def __init__(self, recvQueue: queue.Queue, newQueue: queue.Queue, removeQueue: queue.Queue,
+                 RATE_LIMIT: float, BURST_LIMIT: float, FANOUT_COST: float, NODE_NAME: str, PEER_SECRET: Optional[str],
+                 SEARCH_MESSAGES: int, SEARCH_PATH: Optional[str], AUDIT: Optional[AuditSink]):
         threading.Thread.__init__(self)
 
         # Let main thread signal when to close server
         self._closing: threading.Event = threading.Event()
 
-        self.recvQueue: queue.Queue = recvQueue    # Queue of pairs, {id, message}
-        self.sendQueuesLock: threading.Lock = sendQueuesLock
-        self.sendQueues: Dict[int, queue.Queue] = sendQueues    # dict: key = id, value = queue
+        self.recvQueue: queue.Queue = recvQueue    # Queue of pairs, {session, message}
+        self.newQueue: queue.Queue = newQueue
         self.removeQueue: queue.Queue = removeQueue
 
-
-        # username -> id
-        self.userIDs: Dict[str, int] = {}
-        # id -> username
-        self.usernames : Dict[int, str] = {}
-
-        # Channel name -> users
-        self.channels : Dict[str, List[int]] = {}
-
-        # id -> list of channels
-        self.userChannels: Dict[int, List[str]] = {}
+        # Guards everything below, the main thread adds links
+        self.lock: threading.Lock = threading.Lock()
+
+        # Per connection token buckets, requests cost 1 plus FANOUT_COST per recipient
+        self.rateLimit: float = RATE_LIMIT
+        self.burstLimit: float = BURST_LIMIT
+        self.fanoutCost: float = FANOUT_COST
+
+        # username -> session
+        self.users: Dict[str, Session] = {}
+        # Session id -> session, for every registered user
+        self.sessions: Dict[int, Session] = {}
+
+        # Channel name -> members
+        self.channels : Dict[str, List[Session]] = {}
+
+        # Users that negotiated protocol v2 and want ID mappings
+        self.mapSubscribers: Set[Session] = set()
+        # Users that get user, channel and membership changes pushed
+        self.viewSubscribers: Set[Session] = set()
+
+        # Interned IDs for protocol v2, refs are "#<number>", users use their session id
+        self._channelCounter = itertools.count(1)
+        # Channel name -> ref, ref -> channel name
+        self.channelIDs: Dict[str, str] = {}
+        self.channelRefs: Dict[str, str] = {}
+
+        # Federation with other servers, links must form a tree, a link's name is its peer's node name
+        self.nodeName: str = NODE_NAME
+        # Peers that connect to us must send it in PEER_HELLO, without it only our own links are accepted
+        self.peerSecret: Optional[str] = PEER_SECRET
+        # Link -> channels we told that peer have members on our side
+        self.links: Dict[Session, Set[str]] = {}
+        # Username on another node -> (link towards it, owning node)
+        self.remoteUsers: Dict[str, Tuple[Session, str]] = {}
+        # Channel name -> links with members somewhere behind them
+        self.remoteChannels: Dict[str, Set[Session]] = {}
+
+        # Sorted names of every channel, local or remote, for BROWSE_CHANNELS
+        self.directory: ChannelDirectory = ChannelDirectory()
+
+        # Channel messages seen by local members, for SEARCH
+        self.searchIndex: SearchIndex = SearchIndex(SEARCH_MESSAGES, SEARCH_PATH)
+
+        # Records messages sent by local users, written by its own thread so no disk I/O happens here
+        self.audit: Optional[AuditSink] = AUDIT
+
+        # Big channel messages are delivered a slice at a time between requests
+        # Channel name -> jobs, [recipients, next index, sender, v1 frame, v2 frame, channel ref]
+        self.fanouts: Dict[str, Deque[List]] = {}
+        # Channels with jobs, served round robin
+        self.fanoutOrder: Deque[str] = collections.deque()
 
         self.start()
 
@@ -35,137 +90,629 @@ class Interface(threading.Thread):
     def run(self) -> None:
         while not self._closing.is_set():
             try:
-                id, message = self.recvQueue.get(block=True, timeout=CHECK_THREAD_TIME)
+                # Don't wait for requests while deliveries are pending
+                if self.fanoutOrder:
+                    session, message = self.recvQueue.get_nowait()
+                else:
+                    session, message = self.recvQueue.get(block=True, timeout=CHECK_THREAD_TIME)
             except queue.Empty:
-                continue
+                pass
             else:
-                # Ensure that message is correct length
-                if not codes.isMessageValid(message):
-                    self.sendQueues[id].put(codes.pack([codes.ERROR, "Request ignored, message too long.\n"]))
-                    continue
-                self.processRequest(id, message)
+                # Ensure that message is correct length, peer frames carry names on top
+                if not codes.isMessageValid(message) and session not in self.links:
+                    session.sendQueue.putControl(codes.pack([codes.ERROR, "Request ignored, message too long.\n"]))
+                else:
+                    self.processRequest(session, message)
+
+            # One slice of deliveries per request keeps both moving
+            if self.fanoutOrder:
+                self.runFanouts()
+
+        # Let queued segment writes finish
+        self.searchIndex.close()
 
     def stop(self):
         self._closing.set()
 
     # Must hold the lock
     def clean(self) -> None:
+        # Register new users first. A session can still land on newQueue after the drain and on
+        # removeQueue before it's read, its removal is then skipped and registerUser drops it later
+        while True:
+            try:
+                session = self.newQueue.get_nowait()
+            except queue.Empty:
+                break
+            else:
+                self.registerUser(session)
+
         while True:
-            userID = None
             try:
                 # Check if any user's disconnected
-                userID = self.removeQueue.get_nowait()
+                session = self.removeQueue.get_nowait()
             except queue.Empty:
                 break
             else:
-                # Clear old user's data
-                del self.userIDs[self.usernames[userID]]
-                del self.usernames[userID]
-                del self.userChannels[userID]
-
-                for userIDs in self.channels.values():
-                    if userID in userIDs:
-                        userIDs.remove(userID)
-
-        # Check for empty channels
-        self.channels = {key: value for key, value in self.channels.items() if value != []}
-
-
-    def registerNewUsers(self) -> None:
-        # Init new users
-        for userID in self.sendQueues:
-            # Check if user has a name mapping
-            if userID not in self.usernames:
-                self.userIDs[str(userID)] = userID
-                self.usernames[userID] = str(userID)
-                self.userChannels[userID] = []
-
-    def processRequest(self, senderID, request):
-        tokens: List = codes.unpack(request)
+                if session in self.links:
+                    self.closeLink(session)
+                elif session.id in self.sessions:
+                    self.removeUser(session)
+
+    def removeUser(self, session: Session) -> None:
+        # Clear old user's data
+        del self.users[session.name]
+        del self.sessions[session.id]
+        self.mapSubscribers.discard(session)
+        self.viewSubscribers.discard(session)
+        self.announceUser(codes.PEER_REMOVE, session.name, self.nodeName)
+        self.broadcastMap([codes.USER_ID, session.ref, ""])
+
+        # Only the user's own channels can have emptied
+        channelNames, session.channels = session.channels, []
+        for channelName in channelNames:
+            self.leaveChannel(session, channelName)
+        self.publish([codes.DELTA_USER_REMOVE, session.name, ""])
+
+    def registerUser(self, session: Session) -> None:
+        # Closed before we got to it, registering would leave a user nobody removes
+        if not session.open:
+            return
+
+        # Server links start out as users until they say hello
+        session.name = self.defaultName(session)
+        session.bucket = TokenBucket(self.rateLimit, self.burstLimit)
+        self.users[session.name] = session
+        self.sessions[session.id] = session
+        self.announceUser(codes.PEER_ADD, session.name, self.nodeName)
+        self.broadcastMap([codes.USER_ID, session.ref, session.name])
+        self.publish([codes.DELTA_USER_ADD, session.name, ""])
+
+    # Default names are the session id, suffixed if someone already took it
+    def defaultName(self, session: Session, oldName: Optional[str] = None) -> str:
+        name = str(session.id)
+        suffix = 1
+        while name in self.users or name in self.remoteUsers or name == oldName:
+            name = str(session.id) + "." + str(suffix)
+            suffix += 1
+        return name
+
+    # Push mapping changes to every v2 client
+    def broadcastMap(self, entries: List[str]) -> None:
+        message = codes.pack([codes.ID_MAP] + entries)
+        for session in self.mapSubscribers:
+            # Skip users that disconnected but haven't been cleaned yet
+            if session.open:
+                session.sendQueue.put(message)
+
+    # Push view changes to every subscriber
+    def publish(self, entries: List[str]) -> None:
+        if not self.viewSubscribers:
+            return
+        message = codes.pack([codes.DELTA] + entries)
+        for session in self.viewSubscribers:
+            # Skip users that disconnected but haven't been cleaned yet
+            if session.open:
+                session.sendQueue.put(message)
+
+    # Everything a LIST_USERS, LIST_CHANNELS or LIST_CHANNEL_USERS could return, split over several DELTA frames
+    def viewSnapshot(self) -> List[bytes]:
+        entries: List[str] = [codes.DELTA_RESET, "", ""]
+        for name in list(self.users) + list(self.remoteUsers):
+            entries += [codes.DELTA_USER_ADD, name, ""]
+        for channelName in self.directory.names:
+            entries += [codes.DELTA_CHANNEL_ADD, channelName, ""]
+        for channelName, members in self.channels.items():
+            for member in members:
+                entries += [codes.DELTA_MEMBER_ADD, channelName, member.name]
+        entries += [codes.DELTA_SNAPSHOT_END, "", ""]
+
+        frameFields = 3 * SNAPSHOT_ENTRIES
+        return [codes.pack([codes.DELTA] + entries[i:i + frameFields]) for i in range(0, len(entries), frameFields)]
+
+    # Full mapping snapshot for a client that just switched to v2, split over several ID_MAP frames
+    def mapSnapshot(self) -> List[bytes]:
+        entries: List[str] = []
+        for session in self.sessions.values():
+            entries += [codes.USER_ID, session.ref, session.name]
+        for channelName, channelRef in self.channelIDs.items():
+            entries += [codes.CHANNEL_ID, channelRef, channelName]
+
+        frameFields = 3 * SNAPSHOT_ENTRIES
+        return [codes.pack([codes.ID_MAP] + entries[i:i + frameFields]) for i in range(0, len(entries), frameFields)]
+
+    def addChannel(self, channelName: str, creator: Session) -> None:
+        self.channels[channelName] = [creator]
+        creator.channels.append(channelName)
+
+        channelRef = codes.idRef(next(self._channelCounter))
+        self.channelIDs[channelName] = channelRef
+        self.channelRefs[channelRef] = channelName
+        self.broadcastMap([codes.CHANNEL_ID, channelRef, channelName])
+        self.updatePresence(channelName)
+        self.publish([codes.DELTA_MEMBER_ADD, channelName, creator.name])
+
+    def removeChannel(self, channelName: str) -> None:
+        # Remove channel from each member's joined list
+        for member in self.channels.pop(channelName):
+            member.channels.remove(channelName)
+
+        channelRef = self.channelIDs.pop(channelName)
+        del self.channelRefs[channelRef]
+        self.broadcastMap([codes.CHANNEL_ID, channelRef, ""])
+        self.updatePresence(channelName)
+
+    # Remove a member, channels go away with their last local member
+    def leaveChannel(self, member: Session, channelName: str) -> None:
+        members = self.channels[channelName]
+        members.remove(member)
+        self.publish([codes.DELTA_MEMBER_REMOVE, channelName, member.name])
+        if not members:
+            self.removeChannel(channelName)
+
+    # Channels exist if they have members on this node or behind a link
+    def channelExists(self, channelName: str) -> bool:
+        return channelName in self.channels or channelName in self.remoteChannels
+
+    # Map a channel field to a channel name, returns an error string on failure
+    def resolveChannel(self, token: str) -> Tuple[Optional[str], str]:
+        # Interned IDs skip name validation
+        if codes.isIDRef(token):
+            if token not in self.channelRefs:
+                return None, "Channel ID " + token + " does not exist.\n"
+            return self.channelRefs[token], ""
+
+        if not codes.isValidName(token):
+            return None, "Channel name " + token + " is invalid.\n"
+        return token, ""
+
+    # Map a user field to a session, returns an error string on failure
+    def resolveUser(self, token: str) -> Tuple[Optional[Session], str]:
+        # Interned IDs skip name validation, they're session ids
+        if codes.isIDRef(token):
+            if not token[1:].isdigit() or int(token[1:]) not in self.sessions:
+                return None, "User ID " + token + " does not exist.\n"
+            return self.sessions[int(token[1:])], ""
+
+        if not codes.isValidName(token):
+            return None, "Name " + token + " is invalid.\n"
+        if token not in self.users:
+            return None, "User " + token + " does not exist.\n"
+        return self.users[token], ""
+
+    # Send a message to every member of a channel except the sender
+    def messageChannel(self, sender: Session, channelName: str, text: str) -> None:
+        senderName = sender.name
+        if self.audit is not None:
+            self.audit.record(CHANNEL_MESSAGE, senderName, channelName, text)
+        self.relayChannel(channelName, senderName, text, None)
+
+        # Channel may only have members on other nodes
+        if channelName not in self.channels:
+            return
+
+        line = channelName + "|" + senderName + ": " + text
+        self.searchIndex.add(self.channelIDs[channelName], line, text)
+
+        # Build each frame once, not once per recipient
+        messageV1 = codes.pack([codes.INBOX, line + "\n"])
+        messageV2 = codes.pack([codes.INBOX_IDS, self.channelIDs[channelName], sender.ref, text])
+        self.deliverChannel(channelName, sender, messageV1, messageV2)
+
+    # Deliver to local members, queueing behind earlier messages if the channel is busy
+    def deliverChannel(self, channelName: str, sender: Optional[Session], messageV1: bytes, messageV2: bytes) -> None:
+        recipients = self.channels[channelName]
+
+        # Small channels with nothing queued are delivered right away
+        if channelName not in self.fanouts and len(recipients) <= FANOUT_SLICE:
+            self.deliver(recipients, sender, messageV1, messageV2)
+            return
+
+        # Members are copied so later joins and leaves don't shift the job
+        if channelName not in self.fanouts:
+            self.fanouts[channelName] = collections.deque()
+            self.fanoutOrder.append(channelName)
+        self.fanouts[channelName].append([list(recipients), 0, sender, messageV1, messageV2, self.channelIDs[channelName]])
+
+    def deliver(self, recipients: List[Session], sender: Optional[Session], messageV1: bytes, messageV2: bytes) -> None:
+        for recipient in recipients:
+            # Don't message the sender, or members that left while the job waited
+            if recipient is sender or not recipient.open:
+                continue
+            # Add message to recipient's queue
+            if recipient.protocol == codes.PROTOCOL_V2:
+                recipient.sendQueue.put(messageV2)
+            else:
+                recipient.sendQueue.put(messageV1)
+
+    # Deliver up to FANOUT_SLICE messages for the next busy channel
+    def runFanouts(self) -> None:
+        self.lock.acquire()
+
+        channelName = self.fanoutOrder.popleft()
+        jobs = self.fanouts[channelName]
+        recipients, start, sender, messageV1, messageV2, channelRef = jobs[0]
+
+        # v2 frames name the sender and channel by ID, if either was retired since the job was
+        # queued clients can no longer resolve them, the text frame reads the same
+        senderGone = sender is not None and sender.id not in self.sessions
+        if senderGone or self.channelIDs.get(channelName) != channelRef:
+            messageV2 = messageV1
+
+        end = start + FANOUT_SLICE
+        self.deliver(recipients[start:end], sender, messageV1, messageV2)
+
+        # Jobs in a channel finish in order, so members see messages in order
+        if end < len(recipients):
+            jobs[0][1] = end
+        else:
+            jobs.popleft()
+
+        if jobs:
+            self.fanoutOrder.append(channelName)
+        else:
+            del self.fanouts[channelName]
+
+        self.lock.release()
+
+    # Federation, must hold the lock
+
+    # Called by the main thread once Server.connectPeer opens a link
+    def addLink(self, link: Session) -> None:
+        self.lock.acquire()
+        self.clean()
+        if link.open and link not in self.links:
+            self.openLink(link)
+        self.lock.release()
+
+    def openLink(self, link: Session) -> None:
+        # The link may have been mistaken for a user before it said hello
+        if link.id in self.sessions:
+            self.removeUser(link)
+
+        link.name = ""
+        link.heartbeats = True
+        self.links[link] = set()
+        link.sendQueue.put(codes.pack([codes.PEER_HELLO, self.nodeName, self.peerSecret or ""]))
+
+        # Tell the peer every name and channel on our side of the link
+        for name in self.users:
+            link.sendQueue.put(codes.pack([codes.PEER_USER, codes.PEER_ADD, name, self.nodeName]))
+        for name, (via, owner) in self.remoteUsers.items():
+            if via is not link:
+                link.sendQueue.put(codes.pack([codes.PEER_USER, codes.PEER_ADD, name, owner]))
+        for channelName in set(self.channels) | set(self.remoteChannels):
+            self.announcePresence(link, channelName)
+
+    def closeLink(self, link: Session) -> None:
+        del self.links[link]
+
+        # Forget everything that was reachable through the link
+        for name, (via, owner) in list(self.remoteUsers.items()):
+            if via is link:
+                del self.remoteUsers[name]
+                self.announceUser(codes.PEER_REMOVE, name, owner)
+                self.publish([codes.DELTA_USER_REMOVE, name, ""])
+
+        for channelName in list(self.remoteChannels):
+            self.remoteChannels[channelName].discard(link)
+            if not self.remoteChannels[channelName]:
+                del self.remoteChannels[channelName]
+            self.updatePresence(channelName)
+
+    def announceUser(self, op: str, name: str, owner: str, exceptLink: Optional[Session] = None) -> None:
+        message = codes.pack([codes.PEER_USER, op, name, owner])
+        for link in self.links:
+            if link is not exceptLink:
+                link.sendQueue.put(message)
+
+    # Tell a peer whether the channel has members on our side of its link
+    def announcePresence(self, link: Session, channelName: str) -> None:
+        present = channelName in self.channels
+        for via in self.remoteChannels.get(channelName, ()):
+            present = present or via is not link
+
+        announced = self.links[link]
+        if present == (channelName in announced):
+            return
+
+        if present:
+            announced.add(channelName)
+            link.sendQueue.put(codes.pack([codes.PEER_CHANNEL, codes.PEER_ADD, channelName]))
+        else:
+            announced.remove(channelName)
+            link.sendQueue.put(codes.pack([codes.PEER_CHANNEL, codes.PEER_REMOVE, channelName]))
+
+    # Called whenever a channel may have appeared or gone
+    def updatePresence(self, channelName: str) -> None:
+        self.updateDirectory(channelName)
+        for link in self.links:
+            self.announcePresence(link, channelName)
+
+    def updateDirectory(self, channelName: str) -> None:
+        exists = self.channelExists(channelName)
+        if exists != (channelName in self.directory):
+            if exists:
+                self.directory.add(channelName)
+                self.publish([codes.DELTA_CHANNEL_ADD, channelName, ""])
+            else:
+                self.directory.remove(channelName)
+                self.publish([codes.DELTA_CHANNEL_REMOVE, channelName, ""])
+
+    # Delete a channel on every node
+    def deleteChannel(self, channelName: str, exceptLink: Optional[Session]) -> None:
+        self.remoteChannels.pop(channelName, None)
+
+        # The delete implies the channel is gone, no need to also withdraw it
+        for link, announced in self.links.items():
+            announced.discard(channelName)
+            if link is not exceptLink:
+                link.sendQueue.put(codes.pack([codes.PEER_CHANNEL, codes.PEER_DELETE, channelName]))
+
+        if channelName in self.channels:
+            self.removeChannel(channelName)
+        else:
+            self.updateDirectory(channelName)
+
+    # Forward a channel message once per link that leads to members
+    def relayChannel(self, channelName: str, senderName: str, text: str, exceptLink: Optional[Session]) -> None:
+        message = None
+        for link in self.remoteChannels.get(channelName, ()):
+            if link is exceptLink:
+                continue
+            if message is None:
+                message = codes.pack([codes.PEER_INBOX, channelName, senderName, "", text])
+            link.sendQueue.put(message)
+
+    # Give a local user a default name after losing it to another node
+    def resetName(self, session: Session) -> None:
+        oldName = session.name
+        del self.users[oldName]
+        session.name = self.defaultName(session, oldName)
+        self.users[session.name] = session
+        self.broadcastMap([codes.USER_ID, session.ref, session.name])
+        self.publish([codes.DELTA_USER_RENAME, oldName, session.name])
+        self.announceUser(codes.PEER_ADD, session.name, self.nodeName)
+
+        session.sendQueue.put(codes.pack([codes.INBOX, "Name " + oldName + " was taken on another server, you are now " + session.name + ".\n"]))
+
+    # PEER_HELLO from a connection we didn't open, must carry the shared secret
+    def isTrustedHello(self, tokens: List) -> bool:
+        if self.peerSecret is None or len(tokens) != 3:
+            return False
+        return hmac.compare_digest(tokens[2].encode("utf-8"), self.peerSecret.encode("utf-8"))
+
+    def processPeerFrame(self, link: Session, tokens: List) -> None:
+        match tokens[0]:
+            case codes.PEER_HELLO:
+                # Answer peers that connected to us
+                if link not in self.links:
+                    self.openLink(link)
+                link.name = tokens[1]
+
+            case codes.PEER_USER:
+                op, name, owner = tokens[1:4]
+
+                if op == codes.PEER_ADD:
+                    # Names are unique across nodes, the smaller node name wins a clash
+                    if name in self.users:
+                        if owner >= self.nodeName:
+                            return
+                        self.resetName(self.users[name])
+                    elif name in self.remoteUsers and owner >= self.remoteUsers[name][1]:
+                        return
+
+                    # A winning claim on a known remote name doesn't change the view
+                    if name not in self.remoteUsers:
+                        self.publish([codes.DELTA_USER_ADD, name, ""])
+                    self.remoteUsers[name] = (link, owner)
+                    self.announceUser(codes.PEER_ADD, name, owner, link)
+
+                # Ignore withdrawals of claims that already lost
+                elif name in self.remoteUsers and self.remoteUsers[name][1] == owner:
+                    del self.remoteUsers[name]
+                    self.announceUser(codes.PEER_REMOVE, name, owner, link)
+                    self.publish([codes.DELTA_USER_REMOVE, name, ""])
+
+            case codes.PEER_CHANNEL:
+                op, channelName = tokens[1:3]
+
+                if op == codes.PEER_ADD:
+                    self.remoteChannels.setdefault(channelName, set()).add(link)
+                    self.updatePresence(channelName)
+                elif op == codes.PEER_REMOVE and channelName in self.remoteChannels:
+                    self.remoteChannels[channelName].discard(link)
+                    if not self.remoteChannels[channelName]:
+                        del self.remoteChannels[channelName]
+                    self.updatePresence(channelName)
+                elif op == codes.PEER_DELETE:
+                    self.deleteChannel(channelName, link)
+
+            case codes.PEER_INBOX:
+                channelName, senderName, recipientName, text = tokens[1:5]
+
+                # Direct message, deliver or pass it on towards the recipient
+                if channelName == "":
+                    if recipientName in self.users:
+                        message = codes.pack([codes.INBOX, senderName + ": " + text + "\n"])
+                        self.users[recipientName].sendQueue.put(message)
+                    elif recipientName in self.remoteUsers:
+                        self.remoteUsers[recipientName][0].sendQueue.put(codes.pack(tokens))
+                    return
+
+                self.relayChannel(channelName, senderName, text, link)
+                if channelName in self.channels:
+                    line = channelName + "|" + senderName + ": " + text
+                    self.searchIndex.add(self.channelIDs[channelName], line, text)
+                    message = codes.pack([codes.INBOX, line + "\n"])
+                    self.deliverChannel(channelName, None, message, message)
+
+            # Invalid
+            case _:
+                pass
+
+    # Cost of a request in tokens, grows with the number of frames it produces
+    def requestCost(self, sender: Session, tokens: List) -> float:
+        recipients: int = 0
+
+        match tokens[0]:
+            case codes.MESSAGE_MY_CHANNELS:
+                for channelName in sender.channels:
+                    recipients += len(self.channels[channelName])
+
+            case codes.MESSAGE_CHANNELS:
+                for channelField in tokens[1:-1]:
+                    channelName, _ = self.resolveChannel(channelField)
+                    if channelName in self.channels:
+                        recipients += len(self.channels[channelName])
+
+            # Listings are charged per row
+            case codes.LIST_CHANNELS:
+                recipients = len(self.channels)
+
+            case codes.LIST_USERS:
+                recipients = len(self.users)
+
+            case codes.SEARCH:
+                recipients = SEARCH_RESULTS
+
+            case codes.BROWSE_CHANNELS:
+                recipients = BROWSE_RESULTS
+
+            # Charged for the snapshot, later deltas are free
+            case codes.SUBSCRIBE:
+                recipients = len(self.users) + len(self.remoteUsers) + len(self.directory)
+                recipients += sum(len(members) for members in self.channels.values())
+
+        return 1 + recipients * self.fanoutCost
+
+    def processRequest(self, sender: Session, request: bytes) -> None:
+        # Handlers read fields by position, reject anything they can't before taking the lock
+        try:
+            tokens: List = codes.unpack(request)
+        except (UnicodeDecodeError, struct.error):
+            tokens = []
+        if not tokens or not codes.hasValidFields(tokens):
+            sender.sendQueue.putControl(codes.pack([codes.ERROR, "Request malformed.\n"]))
+            return
+
+        # Heartbeat replies need no answer
+        if tokens[0] == codes.HEARTBEAT:
+            return
         
-        self.sendQueuesLock.acquire()
+        self.lock.acquire()
         self.clean()
-        self.registerNewUsers()
 
         # Check if requester is still online
-        if senderID not in self.sendQueues:
-            self.sendQueuesLock.release()
+        if not sender.open:
+            self.lock.release()
+            return
+
+        # Server links speak their own frames and aren't rate limited
+        if sender in self.links:
+            self.processPeerFrame(sender, tokens)
+            self.lock.release()
+            return
+
+        # Reject requests over the sender's budget before doing any work
+        if not sender.bucket.consume(self.requestCost(sender, tokens)):
+            sender.sendQueue.putControl(codes.pack([codes.ERROR, "Request throttled, slow down.\n"]))
+            self.lock.release()
+            return
+
+        # Only a peer that knows the secret can become a link, other peer frames from clients are ignored
+        if tokens[0] in codes.PEER_FRAMES:
+            if tokens[0] == codes.PEER_HELLO and self.isTrustedHello(tokens):
+                self.processPeerFrame(sender, tokens)
+            self.lock.release()
             return
         
         reply = ""
 
         match tokens[0]:
+            case codes.HELLO:
+                # Any client that knows HELLO answers heartbeats
+                sender.heartbeats = True
+                if tokens[1] == str(codes.PROTOCOL_V1):
+                    sender.protocol = codes.PROTOCOL_V1
+                    self.mapSubscribers.discard(sender)
+                    reply = codes.pack([codes.SUCCESS, "Using protocol 1.\n"])
+                elif tokens[1] == str(codes.PROTOCOL_V2):
+                    sender.protocol = codes.PROTOCOL_V2
+                    self.mapSubscribers.add(sender)
+                    # Client must know every current ID before any frame refers to one
+                    for frame in self.mapSnapshot():
+                        sender.sendQueue.put(frame)
+                    reply = codes.pack([codes.SUCCESS, "Using protocol 2.\n"])
+                else:
+                    reply = codes.pack([codes.ERROR, "Protocol " + tokens[1] + " is not supported.\n"])
+
             case codes.SET_NAME:
                 # Check if name is a valid label
                 if not codes.isValidName(tokens[1]):
                     reply = codes.pack([codes.ERROR, "Name " + tokens[1] + " is invalid.\n"])
-                # Check if name is already in use
-                elif tokens[1] in self.userIDs:
+                # Check if name is already in use here or on another node
+                elif tokens[1] in self.users or tokens[1] in self.remoteUsers:
                     reply = codes.pack([codes.ERROR, "Name " + tokens[1] + " is in use.\n"])
                 else:
                     # Delete old mapping
-                    del self.userIDs[self.usernames[senderID]]
+                    del self.users[sender.name]
+                    self.announceUser(codes.PEER_REMOVE, sender.name, self.nodeName)
+                    self.announceUser(codes.PEER_ADD, tokens[1], self.nodeName)
 
                     # New mapping
-                    self.userIDs[tokens[1]] = senderID
-                    self.usernames[senderID] = tokens[1]
+                    self.users[tokens[1]] = sender
+                    self.publish([codes.DELTA_USER_RENAME, sender.name, tokens[1]])
+                    sender.name = tokens[1]
+                    self.broadcastMap([codes.USER_ID, sender.ref, tokens[1]])
 
                     reply = codes.pack([codes.SUCCESS, "Name changed to " + tokens[1] + ".\n"])
 
             case codes.MESSAGE_USER:
-                # Check if name is a valid label
-                if not codes.isValidName(tokens[1]):
-                    reply = codes.pack([codes.ERROR, "Name " + tokens[1] + " is invalid.\n"])
-                # Retrieve recipient ID
-                elif tokens[1] not in self.userIDs:
-                    reply = codes.pack([codes.ERROR, "User " + tokens[1] + " does not exist.\n"])
+                recipient, error = self.resolveUser(tokens[1])
+
+                # Pass messages for users on other nodes down the link towards them
+                if tokens[1] in self.remoteUsers:
+                    link = self.remoteUsers[tokens[1]][0]
+                    link.sendQueue.put(codes.pack([codes.PEER_INBOX, "", sender.name, tokens[1], tokens[2]]))
+                    if self.audit is not None:
+                        self.audit.record(USER_MESSAGE, sender.name, tokens[1], tokens[2])
+                    reply = codes.pack([codes.SUCCESS, "Message sent.\n"])
+                elif recipient is None:
+                    reply = codes.pack([codes.ERROR, error])
                 # Don't message the sender
-                elif self.userIDs[tokens[1]] == senderID:
+                elif recipient is sender:
                     reply = codes.pack([codes.ERROR, "Cannot message yourself.\n"])
                 else:
                     # Add message to recipient's queue
-                    recipientID = self.userIDs[tokens[1]]
-                    senderName = self.usernames[senderID]
-                    message = codes.pack([codes.INBOX, senderName + ": " + tokens[2] + "\n"])
-                    self.sendQueues[recipientID].put(message)
+                    if recipient.protocol == codes.PROTOCOL_V2:
+                        message = codes.pack([codes.INBOX_IDS, "", sender.ref, tokens[2]])
+                    else:
+                        message = codes.pack([codes.INBOX, sender.name + ": " + tokens[2] + "\n"])
+                    recipient.sendQueue.put(message)
+                    if self.audit is not None:
+                        self.audit.record(USER_MESSAGE, sender.name, recipient.name, tokens[2])
     
                     reply = codes.pack([codes.SUCCESS, "Message sent.\n"])
 
             case codes.MESSAGE_MY_CHANNELS:
                 # Check if sender is in any channels
-                if not self.userChannels[senderID]:
+                if not sender.channels:
                     reply = codes.pack([codes.ERROR, "You aren't in any channels.\n"])
                 else:
-                    channelNames: List[str] = self.userChannels[senderID]
-
-                    for channelName in channelNames:
-                        for recipientID in self.channels[channelName]:
-                                # Don't message the sender
-                                if recipientID == senderID:
-                                    continue
-                                # Add message to recipient's queue
-                                senderName = self.usernames[senderID]
-                                message = codes.pack([codes.INBOX, channelName + "|" + senderName + ": " + tokens[-1] + "\n"])
-                                self.sendQueues[recipientID].put(message)
+                    for channelName in sender.channels:
+                        self.messageChannel(sender, channelName, tokens[-1])
                                 
                     reply = codes.pack([codes.SUCCESS, "Channels messaged.\n"])
 
             case codes.MESSAGE_CHANNELS:
-                for channelName in tokens[1:-1]:
-                    # Check if channel name is a valid label
-                    if not codes.isValidName(channelName):
-                        reply = reply + "Channel name " + channelName + " is invalid.\n"
-                    elif channelName not in self.channels:
+                for channelField in tokens[1:-1]:
+                    channelName, error = self.resolveChannel(channelField)
+                    if channelName is None:
+                        reply = reply + error
+                    elif not self.channelExists(channelName):
                         reply = reply + channelName + " does not exist.\n"
                     else:
-                        for recipientID in self.channels[channelName]:
-                            # Don't message the sender
-                            if recipientID == senderID:
-                                continue
-                            # Add message to recipient's queue
-                            senderName = self.usernames[senderID]
-                            message = codes.pack([codes.INBOX, channelName + "|" + senderName + ": " + tokens[-1] + "\n"])
-                            self.sendQueues[recipientID].put(message)
+                        self.messageChannel(sender, channelName, tokens[-1])
                 
                 if reply != "":
                     reply = codes.pack([codes.ERROR, reply])
@@ -173,18 +720,22 @@ class Interface(threading.Thread):
                     reply = codes.pack([codes.SUCCESS, "Channels Messaged.\n"])
 
             case codes.JOIN_CHANNELS:
-                for channelName in tokens[1:]:
-                    # Check if channel name is a valid label
-                    if not codes.isValidName(channelName):
-                        reply = reply + "Channel name " + channelName + " is invalid.\n"
-                    elif channelName not in self.channels:
+                for channelField in tokens[1:]:
+                    channelName, error = self.resolveChannel(channelField)
+                    if channelName is None:
+                        reply = reply + error
+                    elif not self.channelExists(channelName):
                         reply = reply + channelName + " does not exist.\n"
+                    # First local member of a channel from another node
+                    elif channelName not in self.channels:
+                        self.addChannel(channelName, sender)
                     # Check if sender is already in the channel
-                    elif senderID in self.channels[channelName]:
+                    elif channelName in sender.channels:
                         reply = reply + "You are already listening to " + channelName + ".\n"
                     else:
-                        self.channels[channelName].append(senderID)
-                        self.userChannels[senderID].append(channelName)
+                        self.channels[channelName].append(sender)
+                        sender.channels.append(channelName)
+                        self.publish([codes.DELTA_MEMBER_ADD, channelName, sender.name])
 
                 if reply != "":
                     reply = codes.pack([codes.ERROR, reply])
@@ -192,15 +743,15 @@ class Interface(threading.Thread):
                     reply = codes.pack([codes.SUCCESS, "Joined Channel(s).\n"])
 
             case codes.LEAVE_CHANNELS:
-                for channelName in tokens[1:]:
-                    # Check if channel name is a valid label
-                    if not codes.isValidName(channelName):
-                        reply = reply + "Channel name " + channelName + " is invalid.\n"
-                    elif channelName not in self.userChannels[senderID]:
+                for channelField in tokens[1:]:
+                    channelName, error = self.resolveChannel(channelField)
+                    if channelName is None:
+                        reply = reply + error
+                    elif channelName not in sender.channels:
                         reply = reply + "You are not listening to " + channelName + ".\n"
                     else:
-                        self.channels[channelName].remove(senderID)
-                        self.userChannels[senderID].remove(channelName)
+                        sender.channels.remove(channelName)
+                        self.leaveChannel(sender, channelName)
 
                 if reply != "":
                     reply = codes.pack([codes.ERROR, reply])
@@ -215,40 +766,36 @@ class Interface(threading.Thread):
                     reply = codes.pack([codes.ERROR, "Channel name " + channelName + " is invalid.\n"])
 
                 # Check if specified channel name already exists
-                elif channelName in self.channels:
+                elif self.channelExists(channelName):
                     reply = codes.pack([codes.ERROR, channelName + " is already in use.\n"])
                 
                 # Create and join channel
                 else:
-                    self.channels[channelName] = [senderID]
-                    self.userChannels[senderID].append(channelName)
+                    self.addChannel(channelName, sender)
                     reply = codes.pack([codes.SUCCESS, "Channel created.\n"])
 
             case codes.DELETE_CHANNEL:
-                channelName = tokens[1]
+                channelName, error = self.resolveChannel(tokens[1])
                 
-                # Check if channel name is a valid label
-                if not codes.isValidName(channelName):
-                    reply = codes.pack([codes.ERROR, "Channel name " + channelName + " is invalid.\n"])
+                if channelName is None:
+                    reply = codes.pack([codes.ERROR, error])
 
                 # Check if specified channel name exists
                 elif channelName not in self.channels:
                     reply = codes.pack([codes.ERROR, channelName + " does not exist.\n"])
 
                 # Check if sender is apart of specified channel
-                elif senderID not in self.channels[channelName]:
+                elif channelName not in sender.channels:
                     reply = codes.pack([codes.ERROR, "You are not part of " + channelName + ".\n"])
                 
                 # delete channel
                 else:
-                    del self.channels[channelName]
-                    # Remove channel from each user's joined list
-                    for joinedChannels in self.userChannels.values():
-                        joinedChannels.remove(channelName)
+                    self.deleteChannel(channelName, None)
                     reply = codes.pack([codes.SUCCESS, "Channel deleted.\n"])
 
             case codes.LIST_CHANNELS:
-                for count, channel in enumerate(self.channels):
+                channelNames = list(self.channels) + [name for name in self.remoteChannels if name not in self.channels]
+                for count, channel in enumerate(channelNames):
                     reply = reply + str(count + 1) + ". " + channel + "\n"
 
                 if reply == "":
@@ -257,7 +804,7 @@ class Interface(threading.Thread):
                     reply = codes.pack([codes.SUCCESS, reply])
 
             case codes.LIST_MY_CHANNELS:
-                for count, channelName in enumerate(self.userChannels[senderID]):
+                for count, channelName in enumerate(sender.channels):
                     reply = reply + str(count + 1) + ". " + channelName + "\n"
 
                 if reply == "":
@@ -266,19 +813,18 @@ class Interface(threading.Thread):
                     reply = codes.pack([codes.SUCCESS, reply])
 
             case codes.LIST_CHANNEL_USERS:
-                channelName = tokens[1]
+                channelName, error = self.resolveChannel(tokens[1])
                 
-                # Check if channel name is a valid label
-                if not codes.isValidName(channelName):
-                    reply = codes.pack([codes.ERROR, "Channel name " + channelName + " is invalid.\n"])
+                if channelName is None:
+                    reply = codes.pack([codes.ERROR, error])
 
                 # Check if specified channel name exists
                 elif channelName not in self.channels:
                     reply = codes.pack([codes.ERROR, channelName + " does not exist.\n"])
                 else:
                     count: int = 1
-                    for count, userID in enumerate(self.channels[channelName]):
-                        reply = reply + str(count + 1) + ". " + self.usernames[userID] + "\n"
+                    for count, member in enumerate(self.channels[channelName]):
+                        reply = reply + str(count + 1) + ". " + member.name + "\n"
                         
                     if reply == "":
                         reply = codes.pack([codes.ERROR, channelName + " is empty.\n"])
@@ -286,15 +832,81 @@ class Interface(threading.Thread):
                         reply = codes.pack([codes.SUCCESS, reply])
             
             case codes.LIST_USERS:
-                for count, userID in enumerate(self.sendQueues):
-                    reply = reply + str(count + 1) + ". " + self.usernames[userID] + "\n"
+                for count, name in enumerate(list(self.users) + list(self.remoteUsers)):
+                    reply = reply + str(count + 1) + ". " + name + "\n"
                 
                 reply = codes.pack([codes.SUCCESS, reply])
 
+            case codes.SEARCH:
+                # Only channels the sender is listening to, all of them if none are named
+                channelNames = sender.channels if len(tokens) == 2 else []
+                for channelField in tokens[2:]:
+                    channelName, error = self.resolveChannel(channelField)
+                    if channelName is None:
+                        reply = reply + error
+                    elif channelName not in sender.channels:
+                        reply = reply + "You are not listening to " + channelName + ".\n"
+                    else:
+                        channelNames.append(channelName)
+
+                if reply != "":
+                    reply = codes.pack([codes.ERROR, reply])
+                else:
+                    channelRefs = {self.channelIDs[channelName] for channelName in channelNames}
+                    for count, line in enumerate(self.searchIndex.search(tokens[1], channelRefs, SEARCH_RESULTS)):
+                        reply = reply + str(count + 1) + ". " + line + "\n"
+
+                    if reply == "":
+                        reply = codes.pack([codes.ERROR, "No messages match " + tokens[1] + ".\n"])
+                    else:
+                        reply = codes.pack([codes.SUCCESS, reply])
+
+            case codes.BROWSE_CHANNELS:
+                query = tokens[1]
+
+                if not codes.isValidPattern(query):
+                    reply = codes.pack([codes.ERROR, "Pattern " + query + " is invalid.\n"])
+
+                # Globs list matching names
+                elif isPattern(query):
+                    names, total = self.directory.match(query, BROWSE_RESULTS)
+                    for count, channelName in enumerate(names):
+                        reply = reply + str(count + 1) + ". " + channelName + "\n"
+
+                    if reply == "":
+                        reply = codes.pack([codes.ERROR, "No channels match " + query + ".\n"])
+                    else:
+                        reply = codes.pack([codes.SUCCESS, str(total) + " channels match " + query + "\n" + reply])
+
+                # Prefixes list the next level down, with channel counts
+                else:
+                    for count, (group, size) in enumerate(self.directory.children(query, BROWSE_RESULTS)):
+                        reply = reply + str(count + 1) + ". " + group + " (" + str(size) + ")\n"
+
+                    if reply == "":
+                        reply = codes.pack([codes.ERROR, "No channels start with " + query + ".\n"])
+                    else:
+                        header = str(self.directory.count(query)) + " channels" + (" under " + query if query else "") + "\n"
+                        reply = codes.pack([codes.SUCCESS, header + reply])
+
+            case codes.SUBSCRIBE:
+                if tokens[1] == codes.SUBSCRIBE_ON:
+                    # Snapshot goes first on the bulk lane, so every later delta applies on top of it
+                    if sender not in self.viewSubscribers:
+                        self.viewSubscribers.add(sender)
+                        for frame in self.viewSnapshot():
+                            sender.sendQueue.put(frame)
+                    reply = codes.pack([codes.SUCCESS, "Live updates on.\n"])
+                elif tokens[1] == codes.SUBSCRIBE_OFF:
+                    self.viewSubscribers.discard(sender)
+                    reply = codes.pack([codes.SUCCESS, "Live updates off.\n"])
+                else:
+                    reply = codes.pack([codes.ERROR, "Subscription " + tokens[1] + " is invalid.\n"])
+
             # Invalid
             case _:
                 pass
 
-        # Return reply
-        self.sendQueues[senderID].put(reply)
-        self.sendQueuesLock.release()
+        # Return reply, ahead of any broadcasts still queued for the sender
+        sender.sendQueue.putControl(reply)
+        self.lock.release()
@@ -0,0 +1,25 @@
+import time
+
+class TokenBucket:
+    __slots__ = ("rate", "capacity", "tokens", "_updated")
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate: float = rate    # Tokens refilled per second
+        self.capacity: float = capacity
+        self.tokens: float = capacity
+        self._updated: float = time.monotonic()
+
+    # Returns false if the bucket can't cover the cost
+    def consume(self, cost: float) -> bool:
+        # Refill for the time since the last request
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+        # Requests bigger than the bucket need a full bucket instead of never passing
+        cost = min(cost, self.capacity)
+        if self.tokens < cost:
+            return False
+
+        self.tokens -= cost
+        return True
@@ -0,0 +1,210 @@
+import socket
+import select
+import time
+import argparse
+import collections
+import codes
+import capture
+from typing import Dict, Any, List, Optional, Tuple, Deque
+
+# Replays a capture made with server_run.py --capture against a fresh server,
+# then compares throughput and reply latency with the original run.
+# Captured latency is measured inside the server, replayed latency at the
+# client. For a like for like diff, run the fresh server with --capture too
+# and pass that file with --compare.
+
+DRAIN_TIMEOUT = 5.0  # Seconds to wait for outstanding replies after the last request
+HEARTBEAT_FRAME = codes.pack([codes.HEARTBEAT])
+
+def isReply(frame: bytes) -> bool:
+    return codes.unpack(frame)[0] in (codes.ERROR, codes.SUCCESS)
+
+def percentile(values: List[float], fraction: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+# Replies answer requests in order on each connection, pair them up
+def recordedLatencies(events: List[Tuple[float, int, int, bytes]]) -> List[float]:
+    pending: Dict[int, Deque[float]] = collections.defaultdict(collections.deque)
+    latencies: List[float] = []
+
+    for timestamp, event, number, frame in events:
+        if event == capture.INBOUND and frame != HEARTBEAT_FRAME:
+            pending[number].append(timestamp)
+        elif event == capture.OUTBOUND and pending[number] and isReply(frame):
+            latencies.append(timestamp - pending[number].popleft())
+
+    return latencies
+
+class Replayer:
+    def __init__(self, host: str, port: int, speed: float) -> None:
+        self.host: str = host
+        self.port: int = port
+        self.speed: float = speed    # 0 sends as fast as possible
+
+        self.sockets: Dict[int, socket.socket] = {}    # Capture number -> socket
+        self.numbers: Dict[socket.socket, int] = {}
+        self.buffers: Dict[int, bytes] = {}
+        self.outgoing: Dict[int, bytearray] = {}    # Frames the socket couldn't take yet
+        self.pending: Dict[int, Deque[float]] = collections.defaultdict(collections.deque)
+        self.latencies: List[float] = []
+        self.requests: int = 0
+        self.unanswered: int = 0
+
+    def open(self, number: int) -> None:
+        newSocket = socket.create_connection((self.host, self.port), timeout=5)
+        newSocket.setblocking(False)
+        self.sockets[number] = newSocket
+        self.numbers[newSocket] = number
+        self.buffers[number] = b""
+        self.outgoing[number] = bytearray()
+
+    def close(self, number: int) -> None:
+        oldSocket = self.sockets.pop(number)
+        del self.numbers[oldSocket]
+        del self.buffers[number]
+        del self.outgoing[number]
+        self.unanswered += len(self.pending.pop(number, ()))
+        oldSocket.close()
+
+    def send(self, number: int, frame: bytes) -> None:
+        # Heartbeats are answered live instead
+        if frame == HEARTBEAT_FRAME or number not in self.sockets:
+            return
+        self.pending[number].append(time.monotonic())
+        self.requests += 1
+        self.outgoing[number] += frame
+        self.flush(number)
+
+    # Send as much as the socket takes, the rest waits for it to become writable
+    def flush(self, number: int) -> None:
+        outgoing = self.outgoing[number]
+        try:
+            sent = self.sockets[number].send(outgoing)
+        except BlockingIOError:
+            return
+        except OSError:
+            self.close(number)
+            return
+        del outgoing[:sent]
+
+    # Read replies and finish sends until the deadline, the sockets are always checked at least once
+    # so replies keep being read when sending as fast as possible or behind schedule
+    def poll(self, deadline: float) -> None:
+        while self.sockets:
+            timeout = max(0.0, deadline - time.monotonic())
+            writers = [self.sockets[number] for number, outgoing in self.outgoing.items() if outgoing]
+            readable, writable, _ = select.select(list(self.sockets.values()), writers, [], timeout)
+
+            for iSocket in writable:
+                if iSocket in self.numbers:
+                    self.flush(self.numbers[iSocket])
+
+            for iSocket in readable:
+                # Closed by a failed send
+                if iSocket not in self.numbers:
+                    continue
+                number = self.numbers[iSocket]
+                try:
+                    data = iSocket.recv(65536)
+                except BlockingIOError:
+                    continue
+                except OSError:
+                    data = b""
+                if not data:
+                    self.close(number)
+                    continue
+
+                frames, self.buffers[number] = codes.splitFrames(self.buffers[number] + data)
+                for frame in frames:
+                    if frame == HEARTBEAT_FRAME:
+                        self.outgoing[number] += HEARTBEAT_FRAME
+                        self.flush(number)
+                        if number not in self.sockets:
+                            break
+                    elif self.pending[number] and isReply(frame):
+                        self.latencies.append(time.monotonic() - self.pending[number].popleft())
+
+            if time.monotonic() >= deadline:
+                return
+
+    def run(self, events: List[Tuple[float, int, int, bytes]]) -> float:
+        start = time.monotonic()
+        # Capture times count from server start, skip the quiet stretch before the first event
+        first = events[0][0]
+
+        for timestamp, event, number, frame in events:
+            # Keep the original spacing, scaled by speed
+            if self.speed > 0:
+                self.poll(start + (timestamp - first) / self.speed)
+            else:
+                self.poll(time.monotonic())
+
+            if event == capture.OPEN:
+                self.open(number)
+            elif event == capture.INBOUND:
+                self.send(number, frame)
+            elif event == capture.CLOSE and number in self.sockets:
+                # Let the server answer everything before hanging up, a replay can run far ahead of it
+                deadline = time.monotonic() + DRAIN_TIMEOUT
+                while number in self.sockets and self.pending[number] and time.monotonic() < deadline:
+                    self.poll(min(deadline, time.monotonic() + 0.1))
+                if number in self.sockets:
+                    self.close(number)
+
+        # Collect the last replies
+        deadline = time.monotonic() + DRAIN_TIMEOUT
+        while any(self.pending.values()) and time.monotonic() < deadline:
+            self.poll(min(deadline, time.monotonic() + 0.1))
+
+        duration = time.monotonic() - start
+        for number in list(self.sockets):
+            self.close(number)
+        return duration
+
+def report(label: str, requests: int, duration: float, latencies: List[float]) -> Tuple[float, float]:
+    throughput = requests / duration if duration > 0 else 0.0
+    p50 = percentile(latencies, 0.5) * 1000
+    p99 = percentile(latencies, 0.99) * 1000
+    print(f"{label:<9}{requests:>9} requests {duration:>9.3f}s {throughput:>10.1f} req/s"
+          f"   p50 {p50:.3f}ms  p99 {p99:.3f}ms  max {max(latencies, default=0) * 1000:.3f}ms")
+    return throughput, p99
+
+parser = argparse.ArgumentParser(description="Replay a DreyChat traffic capture against a fresh server")
+parser.add_argument("capture", help="file written by server_run.py --capture")
+parser.add_argument("--host", default="127.0.0.1")
+parser.add_argument("--port", type=int, default=65432)
+parser.add_argument("--speed", type=float, default=1.0, help="time scale, 2 replays twice as fast, 0 as fast as possible")
+parser.add_argument("--compare", default=None, metavar="CAPTURE", help="don't replay, diff against a capture the fresh server recorded during a replay")
+args = parser.parse_args()
+
+def loadCapture(path: str) -> Tuple[List[Tuple[float, int, int, bytes]], int]:
+    events = list(capture.readCapture(path))
+    if not events:
+        print(path + " is empty.")
+        raise SystemExit(1)
+    requests = sum(1 for event in events if event[1] == capture.INBOUND and event[3] != HEARTBEAT_FRAME)
+    return events, requests
+
+events, requests = loadCapture(args.capture)
+recordedThroughput, recordedP99 = report("recorded", requests, events[-1][0] - events[0][0], recordedLatencies(events))
+
+if args.compare is None:
+    replayer = Replayer(args.host, args.port, args.speed)
+    duration = replayer.run(events)
+    replayThroughput, _ = report("replayed", replayer.requests, duration, replayer.latencies)
+    replayP99 = 0.0
+    unanswered = replayer.unanswered
+else:
+    newEvents, newRequests = loadCapture(args.compare)
+    replayThroughput, replayP99 = report("replayed", newRequests, newEvents[-1][0] - newEvents[0][0], recordedLatencies(newEvents))
+    unanswered = newRequests - len(recordedLatencies(newEvents))
+
+if recordedThroughput > 0:
+    print(f"throughput {100 * (replayThroughput / recordedThroughput - 1):+.1f}%", end="")
+# Only server side latencies are comparable
+if recordedP99 > 0 and replayP99 > 0:
+    print(f"   p99 latency {100 * (replayP99 / recordedP99 - 1):+.1f}%", end="")
+print(f"   unanswered {unanswered}")
@@ -0,0 +1,214 @@
+import os
+import re
+import json
+import glob
+import queue
+import itertools
+import threading
+import collections
+from typing import Dict, Any, List, Optional, Tuple, Set, Deque, FrozenSet, Iterator
+
+# Inverted index over channel messages, for SEARCH.
+# The newest messages are kept in memory, evicted ones are optionally written
+# out to segment files by a background thread, so the interface never waits on
+# the disk to spill. Each segment's term dictionary stays in memory and a query
+# only reads the lines that match. Segments only extend this run's history,
+# channel refs restart with the server, so old ones are removed on start.
+
+SEGMENT_MESSAGES = 5000  # Evicted messages per segment file
+MAX_SEGMENTS = 20  # Oldest segment files are deleted past this
+MAX_TERM_LENGTH = 32  # Longer words aren't indexed
+
+WORD = re.compile(r"\w+")
+
+def terms(text: str) -> FrozenSet[str]:
+    return frozenset(word for word in WORD.findall(text.lower()) if len(word) <= MAX_TERM_LENGTH)
+
+class Entry:
+    __slots__ = ("channelRef", "line", "terms")
+
+    def __init__(self, channelRef: str, line: str, terms: FrozenSet[str]) -> None:
+        self.channelRef: str = channelRef    # Channels get a new ref when recreated, old messages stay hidden
+        self.line: str = line    # "channel|sender: text"
+        self.terms: FrozenSet[str] = terms
+
+class Segment:
+    __slots__ = ("path", "entries", "terms", "channels", "offsets")
+
+    # Searched through entries until the writer has the file on disk, then through the dictionary
+    def __init__(self, path: str, entries: List[Entry]) -> None:
+        self.path: str = path
+        self.entries: Optional[List[Entry]] = entries
+        self.terms: Dict[str, List[int]] = {}    # Term -> line numbers
+        self.channels: List[str] = []    # Line number -> channel ref
+        self.offsets: List[int] = []    # Line number -> byte offset
+
+class SegmentWriter(threading.Thread):
+    # Writes and removes segment files in the order they're queued
+    def __init__(self) -> None:
+        threading.Thread.__init__(self)
+        self.jobs: queue.Queue = queue.Queue()    # (segment, remove), None to stop
+        self.start()
+
+    def run(self) -> None:
+        while True:
+            job = self.jobs.get()
+            if job is None:
+                return
+            segment, remove = job
+            if remove:
+                os.remove(segment.path)
+            else:
+                self.write(segment)
+
+    # One JSON line per message
+    def write(self, segment: Segment) -> None:
+        entries = segment.entries
+        termIndex: Dict[str, List[int]] = {}
+        lines: List[bytes] = []
+        for index, entry in enumerate(entries):
+            for term in entry.terms:
+                termIndex.setdefault(term, []).append(index)
+            lines.append(json.dumps(entry.line).encode("utf-8") + b"\n")
+
+        with open(segment.path, "wb") as file:
+            file.writelines(lines)
+
+        segment.terms = termIndex
+        segment.channels = [entry.channelRef for entry in entries]
+        segment.offsets = list(itertools.accumulate((len(line) for line in lines), initial=0))[:-1]
+        # Publish last, searches switch to the file once the dictionary is in place
+        segment.entries = None
+
+class SearchIndex:
+    def __init__(self, MAX_MESSAGES: int, SEGMENT_PATH: Optional[str]) -> None:
+        self.maxMessages: int = MAX_MESSAGES
+        self.segmentPath: Optional[str] = SEGMENT_PATH
+
+        # Message number -> entry, numbers only grow so the first one is the oldest
+        self._counter = itertools.count()
+        self.entries: Dict[int, Entry] = {}
+        # Term -> message numbers, oldest first
+        self.postings: Dict[str, Deque[int]] = {}
+
+        # Evicted entries waiting for a full segment, then segments oldest first
+        self._spill: List[Entry] = []
+        self._segmentCounter = itertools.count(1)
+        self.segments: Deque[Segment] = collections.deque()
+        self._writer: Optional[SegmentWriter] = None
+
+        if self.segmentPath is not None:
+            os.makedirs(self.segmentPath, exist_ok=True)
+            for path in glob.glob(os.path.join(self.segmentPath, "segment-*.json")):
+                os.remove(path)
+            self._writer = SegmentWriter()
+
+    # Waits for queued segment writes
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.jobs.put(None)
+            self._writer.join()
+
+    def add(self, channelRef: str, line: str, text: str) -> None:
+        entry = Entry(channelRef, line, terms(text))
+        number = next(self._counter)
+        self.entries[number] = entry
+        for term in entry.terms:
+            self.postings.setdefault(term, collections.deque()).append(number)
+
+        if len(self.entries) > self.maxMessages:
+            self._evict()
+
+    # Drop the oldest message, it's at the front of each of its postings
+    def _evict(self) -> None:
+        number = next(iter(self.entries))
+        entry = self.entries.pop(number)
+        for term in entry.terms:
+            posting = self.postings[term]
+            posting.popleft()
+            if not posting:
+                del self.postings[term]
+
+        if self.segmentPath is not None:
+            self._spill.append(entry)
+            if len(self._spill) >= SEGMENT_MESSAGES:
+                self._writeSegment()
+
+    # Hand a full spill to the writer, it stays searchable from memory until written
+    def _writeSegment(self) -> None:
+        path = os.path.join(self.segmentPath, "segment-" + str(next(self._segmentCounter)) + ".json")
+        segment = Segment(path, self._spill)
+        self._spill = []
+
+        self.segments.append(segment)
+        self._writer.jobs.put((segment, False))
+        if len(self.segments) > MAX_SEGMENTS:
+            self._writer.jobs.put((self.segments.popleft(), True))
+
+    # Newest first, up to limit lines from the given channels containing every query term
+    def search(self, query: str, channelRefs: Set[str], limit: int) -> List[str]:
+        queryTerms = terms(query)
+        if not queryTerms:
+            return []
+
+        results: List[str] = []
+        for line in self._searchMemory(queryTerms, channelRefs):
+            results.append(line)
+            if len(results) == limit:
+                return results
+
+        # Evicted entries are older than anything in memory
+        for entry in reversed(self._spill):
+            if queryTerms <= entry.terms and entry.channelRef in channelRefs:
+                results.append(entry.line)
+                if len(results) == limit:
+                    return results
+
+        for segment in reversed(self.segments):
+            for line in self._searchSegment(segment, queryTerms, channelRefs, limit - len(results)):
+                results.append(line)
+            if len(results) == limit:
+                return results
+
+        return results
+
+    def _searchMemory(self, queryTerms: FrozenSet[str], channelRefs: Set[str]) -> Iterator[str]:
+        # Walk the rarest term's posting, check the rest against each entry
+        postings = [self.postings.get(term) for term in queryTerms]
+        if None in postings:
+            return
+        for number in reversed(min(postings, key=len)):
+            entry = self.entries[number]
+            if queryTerms <= entry.terms and entry.channelRef in channelRefs:
+                yield entry.line
+
+    def _searchSegment(self, segment: Segment, queryTerms: FrozenSet[str], channelRefs: Set[str], limit: int) -> List[str]:
+        lines: List[str] = []
+
+        # Not written yet
+        entries = segment.entries
+        if entries is not None:
+            for entry in reversed(entries):
+                if queryTerms <= entry.terms and entry.channelRef in channelRefs:
+                    lines.append(entry.line)
+                    if len(lines) == limit:
+                        break
+            return lines
+
+        # Intersect the postings of every term, then filter by channel, only matches touch the disk
+        matches: Optional[Set[int]] = None
+        for term in queryTerms:
+            indexes = set(segment.terms.get(term, ()))
+            matches = indexes if matches is None else matches & indexes
+        if not matches:
+            return lines
+
+        wanted = [index for index in sorted(matches, reverse=True) if segment.channels[index] in channelRefs][:limit]
+        if not wanted:
+            return lines
+
+        with open(segment.path, "rb") as file:
+            for index in wanted:
+                file.seek(segment.offsets[index])
+                lines.append(json.loads(file.readline()))
+        return lines
@@ -0,0 +1,37 @@
+import collections
+from typing import Deque
+
+class SendQueue:
+    # Outbound frames for one connection, in two FIFO lanes.
+    # Control replies go out before bulk INBOX traffic queued ahead of them,
+    # so a busy channel can't make a client's request time out.
+    # deque appends and pops are atomic, one thread fills and one drains.
+    __slots__ = ("_control", "_bulk")
+
+    def __init__(self) -> None:
+        self._control: Deque[bytes] = collections.deque()
+        self._bulk: Deque[bytes] = collections.deque()
+
+    # Bulk lane, for broadcasts and anything that must stay in order with them
+    def put(self, message: bytes) -> None:
+        self._bulk.append(message)
+
+    # Control lane, for SUCCESS/ERROR replies and heartbeats
+    def putControl(self, message: bytes) -> None:
+        self._control.append(message)
+
+    # Must not be empty
+    def get(self) -> bytes:
+        if self._control:
+            return self._control.popleft()
+        return self._bulk.popleft()
+
+    def empty(self) -> bool:
+        return not self._control and not self._bulk
+
+    def qsize(self) -> int:
+        return len(self._control) + len(self._bulk)
+
+    def clear(self) -> None:
+        self._control.clear()
+        self._bulk.clear()
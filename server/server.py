@@ -1,15 +1,26 @@
 import socket
 import threading
-import select
+import selectors
 import queue
+import time
+import codes
+from session import Session
+from localring import LocalListener
+from capture import Capture
 from typing import Dict, Any, List, Optional, Tuple
 
-BUFFER = 1024
+MAX_PENDING = 65536  # Most bytes of an unfinished frame kept per connection
+# TCP keepalive for clients that don't answer heartbeats, only catches dead hosts
+KEEPALIVE_IDLE = 300  # Seconds of silence before the first probe
+KEEPALIVE_INTERVAL = 60  # Seconds between probes
+KEEPALIVE_COUNT = 5  # Unanswered probes before the connection is dropped
+HEARTBEAT_FRAME = codes.pack([codes.HEARTBEAT])
 
 class Server(threading.Thread):
     
     # Start up server thread
-    def __init__(self, HOST: str, PORT: int, CONN_BACKLOG_SIZE: int) -> None:
+    def __init__(self, HOST: str, PORT: int, CONN_BACKLOG_SIZE: int, MAX_CONNECTIONS: int, HEARTBEAT_INTERVAL: float, IDLE_TIMEOUT: float,
+                 LOCAL_PATH: Optional[str], CAPTURE_PATH: Optional[str]) -> None:
         threading.Thread.__init__(self)
 
         # Let main thread signal when to close server
@@ -22,12 +33,40 @@ class Server(threading.Thread):
         self._serverSocket.bind((HOST, PORT))
         self._serverSocket.listen(CONN_BACKLOG_SIZE)
 
-        self._sockets = [self._serverSocket]
+        self._listeners: List = [self._serverSocket]
 
-        self.recieveQueue: queue.Queue = queue.Queue()    # Queue of pairs, {id, message}
-        self.sendQueuesLock: threading.Lock = threading.Lock()
-        self.sendQueues: Dict[int, queue.Queue] = {}    # dict: key = id, value = queue
-        self.removeQueue: queue.Queue = queue.Queue()
+        # Optional shared memory transport for clients on this host
+        self._localListener: Optional[LocalListener] = None
+        if LOCAL_PATH is not None:
+            self._localListener = LocalListener(LOCAL_PATH, CONN_BACKLOG_SIZE)
+            self._listeners.append(self._localListener)
+
+        # epoll where available, select() can't watch descriptors past 1023 and each
+        # local session holds two eventfds
+        self._selector: selectors.BaseSelector = selectors.DefaultSelector()
+        for listener in self._listeners:
+            self._selector.register(listener, selectors.EVENT_READ)
+
+        # Admission control and idle reaping
+        self.maxConnections: int = MAX_CONNECTIONS
+        self.heartbeatInterval: float = HEARTBEAT_INTERVAL
+        self.idleTimeout: float = IDLE_TIMEOUT
+        self._lastReap: float = time.monotonic()
+
+        # Optional recording of all traffic, for replay.py
+        self._capture: Optional[Capture] = None
+        if CAPTURE_PATH is not None:
+            self._capture = Capture(CAPTURE_PATH)
+
+        # One receive buffer for every connection, only this thread reads
+        self._reader: codes.FrameReader = codes.FrameReader()
+
+        # Socket -> session, for every open connection
+        self.sessions: Dict[Any, Session] = {}
+
+        self.recieveQueue: queue.Queue = queue.Queue()    # Queue of pairs, {session, message}
+        self.newQueue: queue.Queue = queue.Queue()    # Sessions opened, for the interface to register
+        self.removeQueue: queue.Queue = queue.Queue()    # Sessions closed
 
         self.start()
 
@@ -35,83 +74,175 @@ class Server(threading.Thread):
         self._closing.set()
 
     def closeSocket(self, socket: socket.socket) -> None:
-        # Remove from interface
-        self.sendQueuesLock.acquire()
-        del self.sendQueues[id(socket)]
-        self.removeQueue.put(id(socket), block=True, timeout=None)
-        self.sendQueuesLock.release()
+        # Remove from interface, it stops queueing for the session right away
+        session = self.sessions.pop(socket)
+        session.open = False
+        self.removeQueue.put(session, block=True, timeout=None)
 
         # Remove socket
-        self._sockets.remove(socket)
+        self._selector.unregister(socket)
         socket.close()
 
+        if self._capture is not None:
+            self._capture.closed(session.id)
+
+    # Let the OS drop dead TCP connections, options missing on some platforms are skipped
+    def keepAlive(self, newSocket) -> None:
+        if not isinstance(newSocket, socket.socket):
+            return
+        newSocket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for option, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+            if hasattr(socket, option):
+                newSocket.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+    def register(self, newSocket: socket.socket) -> Session:
+        self.keepAlive(newSocket)
+        session = Session(newSocket)
+        self._selector.register(newSocket, selectors.EVENT_READ | selectors.EVENT_WRITE)
+        self.sessions[newSocket] = session
+
+        if self._capture is not None:
+            self._capture.opened(session.id)
+
+        # Add connection to interface
+        self.newQueue.put(session, block=True, timeout=None)
+        return session
+
+    # Open a link to another server, returns its session
+    def connectPeer(self, host: str, port: int) -> Optional[Session]:
+        try:
+            peerSocket = socket.create_connection((host, port), timeout=5)
+        except OSError:
+            return None
+
+        peerSocket.setblocking(False)
+        return self.register(peerSocket)
+
+    def accept(self, listener) -> None:
+        # Drain the whole backlog, not just one connection per select
+        while True:
+            try:
+                newSocket, _ = listener.accept()
+            # Backlog is empty, or we're out of descriptors
+            except OSError:
+                break
+
+            newSocket.setblocking(False)
+
+            # Refuse connections over the cap
+            if len(self.sessions) >= self.maxConnections:
+                try:
+                    newSocket.send(codes.pack([codes.ERROR, "Server is full.\n"]))
+                except OSError:
+                    pass
+                newSocket.close()
+                continue
+
+            self.register(newSocket)
+
     def read(self, readable: list):
         
         # Handle inputs
         for iSocket in readable:
-            # Skip already closed sockets
-            if iSocket not in self._sockets:
+            # Accept pending connections
+            if iSocket in self._listeners:
+                self.accept(iSocket)
                 continue
 
-            # Accept pending connection
-            if iSocket  == self._serverSocket:
-                newSocket, _ = iSocket.accept()
-                newSocket.setblocking(False)
-                self._sockets.append(newSocket)
-
-                # Add connection to interface
-                self.sendQueuesLock.acquire()
-                self.sendQueues[id(newSocket)] = queue.Queue()
-                self.sendQueuesLock.release()
+            # Skip already closed sockets
+            session = self.sessions.get(iSocket)
+            if session is None:
                 continue
 
-            # Read message from socket, catch forcible disconnections
-            message = None
+            # Read frames from socket, catch forcible disconnections
+            received = None
             try:
-                message = iSocket.recv(BUFFER)
+                received = self._reader.read(iSocket, session.pending)
+            # Woken up with nothing to read
+            except BlockingIOError:
+                continue
             except:
                 self.closeSocket(iSocket)
                 continue
 
-            # Put incoming data on queue
-            if message:
-                self.recieveQueue.put((id(iSocket), message))
-
             # Closed connections send empty messages
-            else:
+            if received is None:
                 self.closeSocket(iSocket)
+                continue
+
+            session.lastSeen = time.monotonic()
+            frames, session.pending = received
+
+            # Don't buffer endlessly for a frame that never completes
+            if len(session.pending) > MAX_PENDING:
+                self.closeSocket(iSocket)
+                continue
+
+            # Put incoming frames on queue, heartbeats only mark the client as alive
+            for frame in frames:
+                if self._capture is not None:
+                    self._capture.inbound(session.id, frame)
+                # Frames are views into the shared buffer, copy the ones that cross threads
+                if frame != HEARTBEAT_FRAME:
+                    self.recieveQueue.put((session, bytes(frame)))
 
     def write(self, writable: list):
         # Handle outputs
         for iSocket in writable:
-            # Skip if there is nothing to send or if the socket has already been closed
-            if iSocket not in self._sockets or self.sendQueues[id(iSocket)].empty():
+            # Skip listeners, sockets that have already been closed, and sockets with nothing to send
+            session = self.sessions.get(iSocket)
+            if session is None or session.sendQueue.empty():
                 continue
             
             try:
-                iSocket.sendall(self.sendQueues[id(iSocket)].get())
+                message = session.sendQueue.get()
+                iSocket.sendall(message)
                 #print("sent")
 
+                if self._capture is not None:
+                    self._capture.outbound(session.id, message)
+
             except:
                 self.closeSocket(iSocket)
                 continue
 
-    def handle(self, exceptional: list):
-        # Handle "exceptional conditions"
-        for iSocket in exceptional:
-            # Skip already closed sockets
-            if iSocket not in self._sockets:
+    def reap(self):
+        # Only scan connections once per heartbeat interval
+        now = time.monotonic()
+        if now - self._lastReap < self.heartbeatInterval:
+            return
+        self._lastReap = now
+
+        for iSocket, session in list(self.sessions.items()):
+            # Clients that never sent HELLO would be dropped for reading quietly, TCP keepalive covers them
+            if not session.heartbeats:
                 continue
-            self.closeSocket(iSocket)
+            idle = now - session.lastSeen
+
+            # Drop peers that stopped answering heartbeats
+            if idle > self.idleTimeout:
+                self.closeSocket(iSocket)
+            # Quiet clients must answer a heartbeat to stay connected
+            elif idle >= self.heartbeatInterval:
+                session.sendQueue.putControl(HEARTBEAT_FRAME)
 
     # Run thread
     def run(self):
         # Start the server
         while not self._closing.is_set():
-            # Block until a socket becomes readable, writable, or throws an exception
+            # Block until a socket becomes readable or writable, errors and hang ups count as both
             # Times out after 1 second
-            readable, writable, exceptional = select.select(self._sockets, self._sockets, self._sockets, 1)
-            
+            events = self._selector.select(1)
+            readable = [key.fileobj for key, mask in events if mask & selectors.EVENT_READ]
+            writable = [key.fileobj for key, mask in events if mask & selectors.EVENT_WRITE]
+
             self.read(readable)
             self.write(writable)
-            self.handle(exceptional)
+            self.reap()
+
+        # Remove the local socket file
+        if self._localListener is not None:
+            self._localListener.close()
+
+        if self._capture is not None:
+            self._capture.close()
@@ -1,20 +1,72 @@
 import socket
 import threading
 import queue
+import argparse
 from server import Server
 from interface import Interface
+from audit import AuditSink, FSYNC_POLICIES, FSYNC_INTERVAL
 
 HOST = "127.0.0.1"  # Standard loopback interface address (localhost)
 PORT = 65432  # Port to listen on (non-privileged ports are > 1023)
 CONN_BACKLOG_SIZE = 10
+MAX_CONNECTIONS = 1000  # Local clients hold two descriptors each, past ~500 of them raise ulimit -n
+HEARTBEAT_INTERVAL = 15.0  # Seconds of silence before a client is pinged
+IDLE_TIMEOUT = 45.0  # Seconds of silence before a client is dropped
+RATE_LIMIT = 50.0  # Request tokens refilled per second, per connection
+BURST_LIMIT = 500.0  # Most tokens a connection can save up
+FANOUT_COST = 0.1  # Extra tokens per message recipient or listed row
+SEARCH_MESSAGES = 20000  # Channel messages kept in memory for SEARCH
+AUDIT_SEGMENT_SIZE = 64 * 1024 * 1024  # Bytes per audit file before starting the next
+AUDIT_BACKLOG = 100000  # Audit records waiting for the writer before new ones are dropped
 
-server = Server(HOST, PORT, CONN_BACKLOG_SIZE)
-interface = Interface(server.recieveQueue, server.sendQueues, server.sendQueuesLock, server.removeQueue)
+parser = argparse.ArgumentParser(description="DreyChat server")
+parser.add_argument("--port", type=int, default=PORT, help="port to listen on")
+parser.add_argument("--node-name", default=None, help="unique name of this server among its peers, defaults to host:port")
+parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT", help="link to another server, links must not form a cycle")
+parser.add_argument("--peer-secret", default=None, help="shared secret of linked servers, every server in the tree needs the same one, incoming links are refused without it")
+parser.add_argument("--local-path", default=None, help="unix socket path where bots on this host can attach over shared memory")
+parser.add_argument("--capture", default=None, metavar="PATH", help="record all traffic to PATH for replay.py")
+parser.add_argument("--search-path", default=None, metavar="DIR", help="keep SEARCH history evicted from memory in segment files under DIR")
+parser.add_argument("--audit-path", default=None, metavar="DIR", help="record every user and channel message to rotating files under DIR")
+parser.add_argument("--audit-fsync", choices=FSYNC_POLICIES, default=FSYNC_INTERVAL, help="when audit files are synced to disk, after every batch, once a second or never")
+parser.add_argument("--audit-segment-size", type=int, default=AUDIT_SEGMENT_SIZE, metavar="BYTES", help="size an audit file grows to before the next is started")
+parser.add_argument("--backlog", type=int, default=CONN_BACKLOG_SIZE, help="pending connection queue size")
+parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS, help="connections accepted before refusing new ones")
+parser.add_argument("--rate-limit", type=float, default=RATE_LIMIT, help="request tokens refilled per second, per connection")
+parser.add_argument("--burst-limit", type=float, default=BURST_LIMIT, help="most tokens a connection can save up")
+parser.add_argument("--fanout-cost", type=float, default=FANOUT_COST, help="extra tokens per message recipient or listed row")
+parser.add_argument("--heartbeat", type=float, default=HEARTBEAT_INTERVAL, help="seconds of silence before a client that sent HELLO is pinged")
+parser.add_argument("--idle-timeout", type=float, default=IDLE_TIMEOUT, help="seconds of silence before a client that sent HELLO is dropped")
+args = parser.parse_args()
+
+audit = AuditSink(args.audit_path, args.audit_segment_size, args.audit_fsync, AUDIT_BACKLOG) if args.audit_path is not None else None
+server = Server(HOST, args.port, args.backlog, args.max_connections, args.heartbeat, args.idle_timeout, args.local_path, args.capture)
+interface = Interface(server.recieveQueue, server.newQueue, server.removeQueue,
+                      args.rate_limit, args.burst_limit, args.fanout_cost,
+                      args.node_name or HOST + ":" + str(args.port), args.peer_secret,
+                      SEARCH_MESSAGES, args.search_path, audit)
+
+# Link to other servers
+for peer in args.peer:
+    peerHost, peerPort = peer.rsplit(":", 1)
+    link = server.connectPeer(peerHost, int(peerPort))
+    if link is None:
+        print("Failed to link to " + peer + ".")
+    else:
+        interface.addLink(link)
 
 while True:
-    print("[0] Quit\n")
-    if (input('[]<-') == "0"):
+    print("[0] Quit")
+    if audit is not None:
+        print("[1] Audit Status")
+    print()
+    choice = input('[]<-')
+    if choice == "0":
         break
+    # Writer falling behind shows as backlog and lag, then as dropped records
+    elif choice == "1" and audit is not None:
+        stats = audit.stats()
+        print(f"{stats['written']} written, {stats['backlog']} waiting, {stats['lag_seconds']:.1f}s behind, {stats['dropped']} dropped\n")
         
 # Signal threads to close
 server.closeServer()
@@ -24,4 +76,9 @@ interface.stop()
 server.join()
 interface.join()
 
+# Interface is done recording, write out the rest
+if audit is not None:
+    audit.stop()
+    audit.join()
+
 
@@ -0,0 +1,30 @@
+import time
+import itertools
+import codes
+from sendqueue import SendQueue
+from ratelimit import TokenBucket
+from typing import Any, List, Optional
+
+# Session IDs are never reused, unlike id(socket)
+_sessionCounter = itertools.count(1)
+
+class Session:
+    # Everything known about one connection, shared by the server and interface threads.
+    # The server thread owns socket, open, lastSeen and pending, the interface thread
+    # owns name, channels, protocol, bucket and heartbeats. sendQueue is filled by the
+    # interface and drained by the server.
+    __slots__ = ("socket", "id", "ref", "name", "channels", "sendQueue", "protocol", "bucket", "heartbeats", "open", "lastSeen", "pending")
+
+    def __init__(self, socket: Any) -> None:
+        self.socket: Any = socket
+        self.id: int = next(_sessionCounter)
+        self.ref: str = codes.idRef(self.id)    # Protocol v2 user ID
+        self.name: Optional[str] = None    # Set once the interface registers the user, peer node name for links
+        self.channels: List[str] = []
+        self.sendQueue: SendQueue = SendQueue()
+        self.protocol: int = codes.PROTOCOL_V1
+        self.bucket: Optional[TokenBucket] = None
+        self.heartbeats: bool = False    # Set once the client sends HELLO, older clients can't answer heartbeats
+        self.open: bool = True    # Cleared by the server as soon as the connection closes
+        self.lastSeen: float = time.monotonic()    # Last time the client sent anything
+        self.pending: bytes = b""    # Bytes of a partially received frame